@@ -0,0 +1,87 @@
+"""
+Compares the palette extraction backends of walcord (see IMAGE_BACKENDS in main.py).
+
+usage: python benchmarks/bench_extraction.py [image ...] [--repeat N]
+
+Without images a synthetic 4K wallpaper (jpg and png) is generated in a temporary directory.
+The pywal backend is skipped when ImageMagick is not installed.
+"""
+import argparse
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main as walcord
+
+def make_wallpapers(directory: str) -> list:
+    """
+    Writes a synthetic 3840x2160 wallpaper as jpg and png and returns their paths.
+    """
+    import numpy
+    from PIL import Image
+
+    height, width = 2160, 3840
+    y, x = numpy.mgrid[0:height, 0:width]
+    rng = numpy.random.default_rng(0)
+    pixels = numpy.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    pixels = (pixels + rng.integers(-20, 20, pixels.shape)).clip(0, 255).astype(numpy.uint8)
+    for _ in range(12):
+        top, left = rng.integers(0, height - 400), rng.integers(0, width - 600)
+        pixels[top:top + 400, left:left + 600] = rng.integers(0, 255, 3)
+
+    paths = []
+    for extention in (".jpg", ".png"):
+        path = os.path.join(directory, "wallpaper-4k" + extention)
+        Image.fromarray(pixels).save(path)
+        paths.append(path)
+    return paths
+
+def bench(backend: str, image_path: str, repeat: int, tmp_dir: str) -> list:
+    """
+    Returns the extraction times (seconds) of the backend, without the palette caches.
+    """
+    times = []
+    for _ in range(repeat):
+        if backend == "pywal":
+            # pywal caches palettes by image path, give it an empty cache every time
+            walcord.PYWAL_SETTINGS["cache_dir"] = tempfile.mkdtemp(dir=tmp_dir)
+        start = time.perf_counter()
+        walcord.IMAGE_BACKENDS[backend](image_path)
+        times.append(time.perf_counter() - start)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the walcord palette extraction backends.")
+    parser.add_argument("images", nargs="*", help="The images to extract palettes from. (default: a synthetic 4K wallpaper)")
+    parser.add_argument("--repeat", "-r", type=int, default=5, help="How many times to run each backend. (default: 5)")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    tmp_dir = tempfile.mkdtemp(prefix="walcord-bench-")
+    try:
+        images = args.images or make_wallpapers(tmp_dir)
+        backends = list(walcord.IMAGE_BACKENDS)
+        if not (shutil.which("magick") or shutil.which("convert")):
+            print("ImageMagick not found, skipping the pywal backend.")
+            backends.remove("pywal")
+        walcord.IMAGE_BACKENDS["native"](images[0]) # warm up imports
+
+        print(f"{'image':<30} {'backend':<8} {'median':>10} {'min':>10}")
+        for image in images:
+            results = {}
+            for backend in backends:
+                times = bench(backend, image, args.repeat, tmp_dir)
+                results[backend] = statistics.median(times)
+                print(f"{os.path.basename(image):<30} {backend:<8} {results[backend] * 1000:>8.1f}ms {min(times) * 1000:>8.1f}ms")
+            if "pywal" in results:
+                print(f"{'':<30} native is {results['pywal'] / results['native']:.1f}x faster")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
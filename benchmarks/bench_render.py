@@ -0,0 +1,177 @@
+"""
+Benchmarks the walcord rendering stages over the example themes, the default theme and
+generated stress templates with every FIRST_MODIFIERS x SECOND_MODIFIERS combination.
+
+usage: python benchmarks/bench_render.py [--sizes 10000 100000 1000000] [--save results.json] [--compare old.json]
+
+Every stage reports the best of --repeat runs as seconds, KEYs/s and MB/s. Results saved with --save can be
+compared with a later run with --compare, to track performance changes across releases.
+"""
+import argparse
+import datetime
+import glob
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fixtures import REPO_PATH, write_colors
+
+sys.path.insert(0, REPO_PATH)
+import main as walcord
+
+RESULTS_VERSION = 1
+
+def stress_template(keys: int) -> str:
+    """
+    Returns a template with the given number of KEY expressions, cycling through every color,
+    opacity, first modifier and second modifier combination.
+    """
+    first_modifiers = [""] + [modifier for modifier in walcord.FIRST_MODIFIERS if modifier != "DEFAULT"]
+    second_modifiers = [""]
+    for modifier, function in walcord.SECOND_MODIFIERS.items():
+        second_modifiers.append(modifier if function is walcord.invert_modificator else f"{modifier}(1, 20)")
+    colors = ["b", "f", "a", "t", "br", "background", "accent", "0", "7", "13", "15"]
+    opacities = ["", ", 0.5", ", 75"]
+    combinations = itertools.cycle(itertools.product(first_modifiers, second_modifiers, colors, opacities))
+
+    lines = [" * @description stress template"]
+    for n, (first, second, color, opacity) in zip(range(keys), combinations):
+        second = second if first else ""
+        lines.append(f"\t--var-{n}: KEY({color}{opacity}){first}{second}; /* padding */")
+    return "\n".join(lines) + "\n"
+
+def best_time(function, repeat: int) -> float:
+    """
+    Returns the best wall time (seconds) of calling the function repeat times.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def stage(seconds: float, keys: int, size: int) -> dict:
+    return {
+        "seconds": seconds,
+        "keys_per_s": keys / seconds if seconds else 0.0,
+        "mb_per_s": size / seconds / 1024 / 1024 if seconds else 0.0
+    }
+
+def bench_template(name: str, text: str, palette, colors_path: str, tmp_dir: str, repeat: int) -> dict:
+    """
+    Benchmarks every rendering stage on the template text.
+    """
+    lines = text.splitlines(keepends=True)
+    matches = [match for line in lines for match in walcord.KEY_PATTERN.finditer(line)]
+    keys, size = len(matches), len(text.encode())
+
+    def replace_key():
+        for line in lines:
+            try:
+                walcord.replace_key(line, palette.colors)
+            except Exception:
+                pass
+
+    def remap_key():
+        for match in matches:
+            try:
+                walcord.remap_key(match, palette.colors)
+            except Exception:
+                pass
+
+    def render_cold():
+        walcord.render_theme(template, walcord.Palette(palette.colors), name) # a new palette, nothing memoized yet
+
+    template = walcord.compile_theme(lines)
+    theme_path = os.path.join(tmp_dir, name)
+    with open(theme_path, "w") as f:
+        f.write(text)
+    output_path = os.path.join(tmp_dir, "out-" + name)
+    def end_to_end():
+        subprocess.run([sys.executable, "main.py", "-q", "--no-cache", "-j", colors_path, "-t", theme_path, "-o", output_path], cwd=REPO_PATH, check=True, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    stages = {
+        "replace_key": best_time(replace_key, repeat),
+        "remap_key": best_time(remap_key, repeat),
+        "try_replace_key_in_theme": best_time(lambda: walcord.try_replace_key_in_theme(lines, name, palette), repeat),
+        "compile": best_time(lambda: walcord.compile_theme(lines), repeat),
+        "render_cold": best_time(render_cold, repeat),
+        "render_warm": best_time(lambda: walcord.render_theme(template, palette, name), repeat),
+        "main": best_time(end_to_end, repeat)
+    }
+    return {
+        "keys": keys,
+        "bytes": size,
+        "stages": {name: stage(seconds, keys, size) for name, seconds in stages.items()}
+    }
+
+def compare(results: dict, old_results: dict) -> None:
+    """
+    Prints the speedup of every stage against the old results (>1.0 is faster).
+    """
+    print(f"\ncompared with {old_results.get('walcord')} ({old_results.get('date')}):")
+    for name, result in results["templates"].items():
+        old = old_results["templates"].get(name)
+        if not old:
+            continue
+        speedups = []
+        for stage_name, values in result["stages"].items():
+            if stage_name in old["stages"] and values["seconds"]:
+                speedups.append(f"{stage_name} {old['stages'][stage_name]['seconds'] / values['seconds']:.2f}x")
+        print(f"  {name:<22} " + ", ".join(speedups))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the walcord rendering stages.")
+    parser.add_argument("--sizes", "-s", type=int, nargs="+", default=[10000, 100000], help="KEY counts of the stress templates. (default: 10000 100000)")
+    parser.add_argument("--repeat", "-r", type=int, default=3, help="How many times to run each stage, the best run is reported. (default: 3)")
+    parser.add_argument("--save", type=str, help="Save the results to this json file.")
+    parser.add_argument("--compare", "-c", type=str, help="Compare with the results saved by an earlier run.")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL) # stress templates log a lot of expected KEY errors
+
+    tmp_dir = tempfile.mkdtemp(prefix="walcord-bench-")
+    try:
+        colors_path = write_colors(tmp_dir)
+        palette = walcord.Palette.load(colors_path)
+
+        templates = {"DEFAULT_THEME": walcord.DEFAULT_THEME}
+        for path in sorted(glob.glob(os.path.join(REPO_PATH, "examples", "*.css"))):
+            with open(path) as f:
+                templates[os.path.basename(path)] = f.read()
+        for keys in args.sizes:
+            templates[f"stress-{keys}.css"] = stress_template(keys)
+
+        results = {
+            "version": RESULTS_VERSION,
+            "walcord": walcord.VERSION,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "templates": {}
+        }
+        print(f"{'template':<22} {'stage':<26} {'seconds':>10} {'KEYs/s':>12} {'MB/s':>8}")
+        for name, text in templates.items():
+            result = results["templates"][name] = bench_template(name, text, palette, colors_path, tmp_dir, args.repeat)
+            for stage_name, values in result["stages"].items():
+                print(f"{name:<22} {stage_name:<26} {values['seconds']:>10.4f} {values['keys_per_s']:>12.0f} {values['mb_per_s']:>8.2f}")
+
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"\nresults saved to {args.save}")
+        if args.compare:
+            with open(args.compare) as f:
+                compare(results, json.load(f))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Measures the startup of walcord: the import time of main.py and the end-to-end wall time
+of rendering the default theme from a colors.json.
+
+usage: python benchmarks/bench_startup.py [--repeat N] [--binary dist/walcord] [--max-import-ms MS] [--max-run-ms MS]
+
+With --max-import-ms/--max-run-ms the script exits with 1 when the median is slower, so it can catch regressions.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fixtures import REPO_PATH, write_colors
+
+def run(command: list, repeat: int, env: dict, output: str = None) -> list:
+    """
+    Returns the wall times (seconds) of running the command repeat times.
+    With an output directory, every run writes to a new --output in it, so walcord's render manifest
+    never skips the render of a run that came before.
+    """
+    times = []
+    for n in range(repeat):
+        run_command = command + ["-o", os.path.join(output, f"walcord-{n}.theme.css")] if output else command
+        start = time.perf_counter()
+        subprocess.run(run_command, cwd=REPO_PATH, env=env, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the walcord startup.")
+    parser.add_argument("--repeat", "-r", type=int, default=10, help="How many times to run each measurement. (default: 10)")
+    parser.add_argument("--binary", "-b", type=str, help="Measure a built walcord binary instead of `python main.py`.")
+    parser.add_argument("--max-import-ms", type=float, help="Fail if the median import time is slower.")
+    parser.add_argument("--max-run-ms", type=float, help="Fail if the median end-to-end time is slower.")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="walcord-bench-")
+    try:
+        colors_path = write_colors(tmp_dir)
+        # keep the user's caches out of the measurement
+        env = {**os.environ, "XDG_CACHE_HOME": tmp_dir}
+        walcord = [args.binary] if args.binary else [sys.executable, "main.py"]
+
+        interpreter = run([sys.executable, "-c", "pass"], args.repeat, env)
+        imported = run([sys.executable, "-c", "import main"], args.repeat, env)
+        end_to_end = run([*walcord, "-q", "-j", colors_path], args.repeat, env, tmp_dir)
+
+        import_ms = (statistics.median(imported) - statistics.median(interpreter)) * 1000
+        run_ms = statistics.median(end_to_end) * 1000
+        print(f"interpreter startup: {statistics.median(interpreter) * 1000:8.1f}ms")
+        print(f"import main:         {import_ms:8.1f}ms (without interpreter startup)")
+        print(f"default theme run:   {run_ms:8.1f}ms (min {min(end_to_end) * 1000:.1f}ms, {' '.join(walcord)})")
+
+        failed = False
+        if args.max_import_ms is not None and import_ms > args.max_import_ms:
+            print(f"FAIL: import time {import_ms:.1f}ms > {args.max_import_ms}ms")
+            failed = True
+        if args.max_run_ms is not None and run_ms > args.max_run_ms:
+            print(f"FAIL: run time {run_ms:.1f}ms > {args.max_run_ms}ms")
+            failed = True
+        sys.exit(1 if failed else 0)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""
+Shared fixtures of the walcord benchmarks.
+"""
+import json
+import os
+
+REPO_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+COLORS = {
+    "wallpaper": "/tmp/wallpaper.png",
+    "alpha": "100",
+    "special": {"background": "#1a1b26", "foreground": "#c0caf5", "cursor": "#c0caf5"},
+    "colors": {f"color{i}": color for i, color in enumerate([
+        "#1a1b26", "#f7768e", "#9ece6a", "#e0af68", "#7aa2f7", "#bb9af7", "#7dcfff", "#a9b1d6",
+        "#414868", "#f7768e", "#9ece6a", "#e0af68", "#7aa2f7", "#bb9af7", "#7dcfff", "#c0caf5"
+    ])}
+}
+
+def write_colors(directory: str) -> str:
+    """
+    Writes COLORS as a pywal colors.json in the directory and returns its path.
+    """
+    path = os.path.join(directory, "colors.json")
+    with open(path, "w") as f:
+        json.dump(COLORS, f)
+    return path
@@ -1,21 +1,45 @@
 import argparse
-import pywal
 import os
 import sys
 import re
 import json
 import logging
-import ctypes
 import select
-import colorsys
-
-logging.basicConfig(level=logging.INFO)
-logging.getLogger().handlers[0].setFormatter(logging.Formatter('%(asctime)s (%(levelname)s) - %(message)s'))
-
+import shutil
+import collections
+import functools
+import struct
+import time
+import hashlib
+import mmap
+import fnmatch
+import contextlib
+import threading
+# pywal, ctypes, colorsys, multiprocessing and numpy are imported where they are used,
+# so a plain `walcord -j colors.json` doesn't pay for them at startup
+
+VERSION = "2.9.1"
 HOME_PATH = os.environ['HOME']
 ORIGIN_VESKTOP_THEME_PATH = os.path.join(HOME_PATH, ".config/vesktop/themes")
-IS_STDIN = select.select([sys.stdin], [], [], 0.0)[0]
-colors = {}
+CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(HOME_PATH, ".cache")), "walcord")
+TEMPLATE_CACHE_PATH = os.path.join(CACHE_PATH, "templates")
+TEMPLATE_CACHE_VERSION = 2
+TEMPLATE_CACHE_MAX_ENTRIES = 1024
+PALETTE_CACHE_PATH = os.path.join(CACHE_PATH, "palettes")
+PALETTE_CACHE_MAX_ENTRIES = 4096 # enough for a --prewarm'ed wallpaper rotation
+PREWARM_NICENESS = 10
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff")
+MANIFEST_PATH = os.path.join(CACHE_PATH, "manifest.json")
+MANIFEST_VERSION = 1
+PYWAL_SETTINGS = {"backend": "wal", "light": False, "sat": ""}
+NATIVE_BACKEND_SIZE = 128
+NATIVE_BACKEND_VERSION = 1
+DEFAULT_COLORS_JSON_PATH = os.path.join(HOME_PATH, ".cache/wal/colors.json")
+SERVICE_DEBOUNCE = 0.5
+SERVER_CACHE_MAX_ENTRIES = 1024
+SERVER_MAX_REQUEST_SIZE = 64 * 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+IS_STDIN = False
 DEFAULT_THEME = """
 /**
  * @name Walcord Default Theme
@@ -87,32 +111,236 @@ DEFAULT_THEME = """
 }
 """
 
+def save_cache_file(cache_file: str, entry: dict) -> None:
+    """
+    Atomically writes the cache entry as json. Errors are not fatal, the entry is just computed again next time.
+
+    :param cache_file: The path to the cache file.
+    :type cache_file: str
+    :param entry: The json serializable cache entry.
+    :type entry: dict
+    """
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = get_tmp_path(cache_file)
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_file, cache_file)
+        finally:
+            with contextlib.suppress(FileNotFoundError): os.remove(tmp_file)
+    except OSError as e:
+        logging.warning(f"(walcord) can't write cache file {cache_file}: {e}")
+
+def hash_file(path: str) -> str:
+    """
+    Returns the sha256 hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_palette_cache_file(image_path: str, backend: str = "pywal") -> str:
+    """
+    Returns the palette cache file for the image. The cache is keyed by the image content
+    and the backend settings, so a renamed or moved wallpaper still hits the cache.
+
+    :param image_path: The path to the image.
+    :type image_path: str
+    :param backend: The name of the image backend (see IMAGE_BACKENDS).
+    :type backend: str
+    :return: The path to the cache file.
+    :rtype: str
+    """
+    if backend == "pywal":
+        import pywal
+        settings = {**PYWAL_SETTINGS, "pywal": pywal.__version__}
+    else:
+        settings = {"backend": backend, "version": NATIVE_BACKEND_VERSION, "size": NATIVE_BACKEND_SIZE}
+    key = hashlib.sha256(f"{hash_file(image_path)}{json.dumps(settings, sort_keys=True)}".encode()).hexdigest()
+    return os.path.join(PALETTE_CACHE_PATH, key + ".json")
+
+def evict_cache(directory: str = PALETTE_CACHE_PATH, suffix: str = ".json", max_entries: int = PALETTE_CACHE_MAX_ENTRIES) -> None:
+    """
+    Removes the least recently used cache files (by mtime, touched on every use) of the cache directory
+    until there are at most max_entries of them. Files removed meanwhile by another walcord are ignored.
+
+    :param directory: The cache directory (PALETTE_CACHE_PATH or TEMPLATE_CACHE_PATH).
+    :type directory: str
+    :param suffix: The suffix of the cache files, so temporary files are left alone.
+    :type suffix: str
+    :param max_entries: The number of cache files to keep.
+    :type max_entries: int
+    """
+    try:
+        entries = [entry for entry in os.scandir(directory) if entry.name.endswith(suffix)]
+    except OSError:
+        return
+    if len(entries) <= max_entries:
+        return
+    used = []
+    for entry in entries:
+        with contextlib.suppress(FileNotFoundError):
+            used.append((entry.stat().st_mtime_ns, entry.path))
+    used.sort()
+    for _, path in used[:len(used) - max_entries]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"(walcord) can't remove cache file {path}: {e}")
+
 def get_colors_pywal(image_path: str) -> dict:
     """
-    Returns a dictionary of colors generated from the given image path.
+    Returns a dictionary of colors generated from the given image path with pywal.
 
     :param image_path: The path to the image to generate colors from.
     :type image_path: str
     :return: A dictionary of colors in the format of pywal.
     :rtype: dict
     """
-    logging.info(f"(walcord) getting colors from image: {image_path}")
-    return pywal.colors.get(image_path)
+    import pywal.colors
+    try:
+        return pywal.colors.get(image_path, **PYWAL_SETTINGS)
+    except SystemExit: # pywal logs why and exits
+        raise ValueError(f"pywal can't generate colors from {image_path}.") from None
+
+def darken_color(color: tuple, amount: float) -> tuple:
+    return tuple(int(col * (1 - amount)) for col in color)
+
+def blend_color(color: tuple, color2: tuple) -> tuple:
+    return tuple(int(0.5 * c1 + 0.5 * c2) for c1, c2 in zip(color, color2))
 
-def get_colors_json(path:str = os.path.join(HOME_PATH, ".cache/wal/colors.json")) -> dict:
+def kmeans_palette(pixels, k: int = 16, iterations: int = 10):
+    """
+    Quantizes the pixels to k colors with k-means, sorted from the darkest to the brightest.
+
+    :param pixels: The (n, 3) numpy array of rgb pixels.
+    :param k: The number of colors.
+    :type k: int
+    :param iterations: The number of k-means iterations.
+    :type iterations: int
+    :return: The (k, 3) numpy array of colors.
+    """
+    import numpy
+
+    luminance = pixels @ numpy.array([0.299, 0.587, 0.114], dtype=numpy.float32)
+    order = numpy.argsort(luminance, kind="stable")
+    # deterministic start: centers spread evenly over the luminance range
+    centers = pixels[order[numpy.linspace(0, len(order) - 1, k).astype(int)]].copy()
+    pixels_sq = (pixels * pixels).sum(axis=1)[:, None]
+    for _ in range(iterations):
+        distances = pixels_sq - 2 * pixels @ centers.T + (centers * centers).sum(axis=1)[None, :]
+        labels = distances.argmin(axis=1)
+        counts = numpy.bincount(labels, minlength=k)
+        sums = numpy.stack([numpy.bincount(labels, weights=pixels[:, c], minlength=k) for c in range(3)], axis=1)
+        filled = counts > 0
+        new_centers = centers.copy()
+        new_centers[filled] = (sums[filled] / counts[filled, None]).astype(numpy.float32)
+        if numpy.allclose(new_centers, centers, atol=0.5):
+            centers = new_centers
+            break
+        centers = new_centers
+    return centers[numpy.argsort(centers @ numpy.array([0.299, 0.587, 0.114], dtype=numpy.float32), kind="stable")]
+
+def get_colors_native(image_path: str) -> dict:
+    """
+    Returns a dictionary of colors generated from the given image path without external tools:
+    the image is downsampled to NATIVE_BACKEND_SIZE and quantized with numpy (see kmeans_palette).
+    The colors are adjusted like pywal's wal backend does.
+
+    :param image_path: The path to the image to generate colors from.
+    :type image_path: str
+    :return: A dictionary of colors in the format of pywal.
+    :rtype: dict
+    """
+    try:
+        import numpy
+        from PIL import Image
+    except ImportError as e:
+        raise ImportError(f"the native backend needs numpy and Pillow ({e}).") from e
+
+    with Image.open(image_path) as image:
+        image.draft("RGB", (NATIVE_BACKEND_SIZE, NATIVE_BACKEND_SIZE)) # lets jpeg decode at a lower resolution
+        image = image.convert("RGB")
+        image.thumbnail((NATIVE_BACKEND_SIZE, NATIVE_BACKEND_SIZE), Image.Resampling.BILINEAR)
+        pixels = numpy.asarray(image, dtype=numpy.float32).reshape(-1, 3)
+
+    colors = [tuple(int(round(c)) for c in color) for color in kmeans_palette(pixels, 16)]
+    colors = colors[:1] + colors[8:16] + colors[8:-1]
+    if colors[0][0] >= 16:
+        colors[0] = darken_color(colors[0], 0.40)
+    colors[7] = blend_color(colors[7], (238, 238, 238))
+    colors[8] = darken_color(colors[7], 0.30)
+    colors[15] = blend_color(colors[15], (238, 238, 238))
+    colors = [f"#{r:02x}{g:02x}{b:02x}" for r, g, b in colors]
+
+    return {
+        "wallpaper": image_path,
+        "alpha": "100",
+        "special": {
+            "background": colors[0],
+            "foreground": colors[15],
+            "cursor": colors[15]
+        },
+        "colors": {f"color{i}": color for i, color in enumerate(colors)}
+    }
+
+IMAGE_BACKENDS = {
+    'pywal': get_colors_pywal,
+    'native': get_colors_native
+}
+
+def get_colors_image(image_path: str, use_cache: bool = True, backend: str = "pywal") -> dict:
+    """
+    Returns a dictionary of colors generated from the given image path with the image backend.
+    Generated palettes are cached in PALETTE_CACHE_PATH (see get_palette_cache_file).
+
+    :param image_path: The path to the image to generate colors from.
+    :type image_path: str
+    :param use_cache: Read and write the palette cache.
+    :type use_cache: bool
+    :param backend: The name of the image backend (see IMAGE_BACKENDS).
+    :type backend: str
+    :return: A dictionary of colors in the format of pywal.
+    :rtype: dict
+    """
+    logging.info(f"(walcord) getting colors from image: {image_path}")
+    cache_file = get_palette_cache_file(image_path, backend) if use_cache else None
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                colors = json.load(f)
+            os.utime(cache_file) # mark as recently used
+            colors["wallpaper"] = image_path
+            logging.info(f"(walcord) using cached palette: {cache_file}")
+            return colors
+        except (OSError, ValueError) as e:
+            logging.warning(f"(walcord) broken cached palette {cache_file}: {e}")
+
+    colors = IMAGE_BACKENDS[backend](image_path)
+    if cache_file:
+        save_cache_file(cache_file, colors)
+        evict_cache(PALETTE_CACHE_PATH, ".json", PALETTE_CACHE_MAX_ENTRIES)
+    return colors
+
+def get_colors_json(path:str = DEFAULT_COLORS_JSON_PATH) -> dict:
     """
     Returns a dictionary of colors from the pywal json file.
 
     :return: A dictionary of colors in the format of pywal.
     :rtype: dict
+    :raises ValueError: If the path is not a json file.
+    :raises FileNotFoundError: If the file doesn't exist.
     """
     logging.info(f"(walcord) getting colors from json ({path})...")
     if not path.endswith('.json'):
-        logging.error(f"(walcord) Error: {path} is not a json file.")
-        sys.exit(-1)
+        raise ValueError(f"{path} is not a json file.")
     elif not os.path.exists(path):
-        logging.error(f"(walcord) Error: {path} not found. Maybe you should run 'wal' first?")
-        sys.exit(-1)
+        raise FileNotFoundError(f"{path} not found. Maybe you should run 'wal' first?")
 
     with open(path) as f:
         return json.load(f)
@@ -160,6 +388,19 @@ def map_colors(colors: dict) -> dict:
 
     }
 
+@functools.lru_cache(maxsize=1024)
+def hex_to_rgb(color: str) -> tuple:
+    """
+    Converts the hex color to rgb. Conversions are memoized, so palettes sharing colors
+    (aliases like 'b' and 'background', or many palettes in --batch) convert each color once.
+
+    :param color: The hex color (#RRGGBB).
+    :type color: str
+    :return: The color converted to rgb.
+    :rtype: tuple
+    """
+    return tuple(int(color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+
 def hex_to_rgb_map(colors: dict) -> dict:
     """
     Maps the hex colors to rgb colors.
@@ -172,7 +413,7 @@ def hex_to_rgb_map(colors: dict) -> dict:
     returned = {}
     for color in colors:
         try:
-            returned[color] = tuple(int(colors[color].lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+            returned[color] = hex_to_rgb(colors[color])
         except ValueError:
             if color == "wallpaper" or color == "w":
                 returned[color] = colors[color] # wallpaper path (expecting string)
@@ -181,15 +422,17 @@ def hex_to_rgb_map(colors: dict) -> dict:
             continue
     return returned
 
+@functools.lru_cache(maxsize=1024)
 def rgb_to_hls(color: tuple) -> tuple:
     """
-    Converts the given rgb color to hls.
+    Converts the given rgb color to hls (memoized like hex_to_rgb).
 
     :param color: The color to convert to hls.
     :type color: tuple
     :return: The color converted to hls.
     :rtype: tuple
     """
+    import colorsys
     r, g, b = color
     return colorsys.rgb_to_hls(r / 255.0, g / 255.0, b / 255.0)
 
@@ -248,25 +491,39 @@ def return_hex_values_string(color_tuple, opacity, scond_mod = {"pos": 0, "mod":
     color_tuple = check_and_apply_second_modificator(color_tuple, scond_mod)
     return f"{color_tuple[0]:02x}{color_tuple[1]:02x}{color_tuple[2]:02x}"
 
+def to_css_hsl(color_tuple: tuple, scond_mod: dict) -> tuple:
+    """
+    Returns the rgb color as css hsl values: the hue in degrees, the saturation and the lightness in percents,
+    with the second modifier applied to them (invert inverts the rgb color).
+
+    :return: The (h, s, l) values as strings.
+    :rtype: tuple
+    """
+    if scond_mod["type"] == "invert":
+        color_tuple, scond_mod = invert_color(color_tuple), {"pos": 0, "mod": 0, "type": None}
+    h, l, s = rgb_to_hls(color_tuple)
+    h, s, l = check_and_apply_second_modificator((h * 360, s * 100, l * 100), scond_mod)
+    return tuple(f"{round(value, 1) + 0.0:g}" for value in (h, s, l)) # + 0.0 turns -0.0 into 0.0
+
 def return_hsl_string(color_tuple, opacity, scond_mod = {"pos": 0, "mod": 0, "type": None}): 
-    h, l, s = check_and_apply_second_modificator(rgb_to_hls(color_tuple))
-    return f"hsl({h},{l},{s})"
+    h, s, l = to_css_hsl(color_tuple, scond_mod)
+    return f"hsl({h},{s}%,{l}%)"
 
 def return_h_from_hsl_string(color_tuple, opacity, scond_mod = {"pos": 0, "mod": 0, "type": None}):
-    h, l, s = check_and_apply_second_modificator(rgb_to_hls(color_tuple))
+    h, s, l = to_css_hsl(color_tuple, scond_mod)
     return f"{h}"
 
 def return_s_from_hsl_string(color_tuple, opacity, scond_mod = {"pos": 0, "mod": 0, "type": None}):
-    h, l, s = check_and_apply_second_modificator(rgb_to_hls(color_tuple))
-    return f"{s}"
+    h, s, l = to_css_hsl(color_tuple, scond_mod)
+    return f"{s}%"
 
 def return_l_from_hsl_string(color_tuple, opacity, scond_mod = {"pos": 0, "mod": 0, "type": None}):
-    h, l, s = check_and_apply_second_modificator(rgb_to_hls(color_tuple))
-    return f"{l}"
+    h, s, l = to_css_hsl(color_tuple, scond_mod)
+    return f"{l}%"
 
 def return_hsl_values_string(color_tuple, opacity, scond_mod = {"pos": 0, "mod": 0, "type": None}):
-    h, l, s = check_and_apply_second_modificator(rgb_to_hls(color_tuple))
-    return f"{h},{l},{s}"
+    h, s, l = to_css_hsl(color_tuple, scond_mod)
+    return f"{h},{s}%,{l}%"
 
 FIRST_MODIFIERS = {
     'DEFAULT': return_rgba_string,
@@ -302,6 +559,54 @@ FIRST_MODIFIERS = {
     '.lightness': return_l_from_hsl_string
 }
 
+class Color:
+    """
+    A palette color with its string in every format of FIRST_MODIFIERS, computed once,
+    so evaluating a KEY is a lookup (and a format of its opacity if it isn't 1.0).
+    """
+    __slots__ = ("rgb", "strings", "opacity_templates")
+
+    def __init__(self, rgb: tuple):
+        """
+        :param rgb: The color in rgb.
+        :type rgb: tuple
+        """
+        self.rgb = rgb
+        self.strings = {}
+        self.opacity_templates = {} # the formats with the opacity, like "rgba(r,g,b,{})"
+        for name, to_string in FIRST_MODIFIERS.items():
+            string = to_string(rgb, "{}")
+            if "{}" in string:
+                self.opacity_templates[name] = string
+                string = string.format(1.0)
+            self.strings[name] = string
+
+    def to_string(self, name: str, opacity: float = 1.0) -> str:
+        """
+        Returns the color in the format (a key of FIRST_MODIFIERS) with the opacity.
+        """
+        if opacity != 1.0 and name in self.opacity_templates:
+            return self.opacity_templates[name].format(opacity)
+        return self.strings[name]
+
+@functools.lru_cache(maxsize=1024)
+def get_color(rgb: tuple) -> Color:
+    """
+    Returns the Color of the rgb color (memoized like hex_to_rgb, so the aliases of a color share it).
+    """
+    return Color(rgb)
+
+def precompute_colors(colors: dict) -> dict:
+    """
+    Maps the rgb colors to Colors. Values that aren't colors (the wallpaper path) are kept as they are.
+
+    :param colors: The colors mapped to rgb (see hex_to_rgb_map).
+    :type colors: dict
+    :return: The colors mapped to Colors.
+    :rtype: dict
+    """
+    return {name: get_color(color) if isinstance(color, tuple) else color for name, color in colors.items()}
+
 def add_modificator(params):
     # print(params)
     p = params.replace(" ","").replace("(", "").replace(")", "").split(",")
@@ -336,33 +641,54 @@ SECOND_MODIFIERS = {
 
     
 
-def remap_key(match: re.Match) -> str:
+KEY_PATTERN = re.compile(r'KEY\((\w+)(?:,\s*(\d+(?:\.\d+)?))?\)(\.\w+)?(\.\w+(\(\d+(?:\.\d+)?(?:,\s*\d+(?:\.\d+)?)?\))?)?', re.IGNORECASE)
+KEY_PROBE_PATTERN = re.compile(r'KEY\([^)]*\)', re.IGNORECASE)
+# what makes a rendered theme file differ from the file itself: a KEY, the @description line
+# (see iter_replace_description) and \r (translated when the file is read as text)
+FICLONE = 0x40049409 # the linux ioctl cloning a file on CoW filesystems (btrfs, xfs...)
+RENDER_BYTES_PATTERN = re.compile(rb'KEY\(|@description|\r', re.IGNORECASE)
+BINARY_PROBE_SIZE = 8192 # a file with a NUL byte in its first bytes is binary (like git does)
+
+class KeyNode:
     """
-    Remaps the key to the css rgba format.
+    A pre-parsed KEY(...) expression. Everything that doesn't depend on the palette
+    (opacity, modifiers and their errors) is resolved once at compile time.
+    """
+    __slots__ = ("color", "opacity", "first_modifier", "second_modifier", "error", "cache_key")
+
+    def __init__(self, color: str, opacity: float, first_modifier: str, second_modifier: dict, error: str = None):
+        self.color = color
+        self.opacity = opacity
+        self.first_modifier = first_modifier
+        self.second_modifier = second_modifier
+        self.error = error
+        # the normalized expression, equal for every KEY that evaluates to the same string
+        self.cache_key = (color, opacity, first_modifier, second_modifier["type"], second_modifier["pos"], second_modifier["mod"], error)
+
+def parse_key(match: re.Match) -> KeyNode:
+    """
+    Parses the KEY match into a KeyNode.
 
-    :param match: The match object to remap.
+    :param match: The match object of KEY_PATTERN.
     :type match: re.Match
+    :return: The parsed KEY expression.
+    :rtype: KeyNode
     """
+    error = None
     first_arg = match.group(1).lower()
-    first_arg_values = colors.get(first_arg)
-    if not first_arg_values:
-        raise ValueError(f"Color '{first_arg}' not found in the colors dictionary.")
     second_arg = match.group(2) if match.group(2) else "1.0"
+    opacity = 1.0
     try:
         second_arg = float(second_arg)
         if second_arg < 0.0:
-            opacity = 1.0
             raise ValueError(f"Opacity value is not a valid: {second_arg} (it should be 0.0-1.0 or 1-100). Opacity will be set to 1.0...")
         if second_arg > 1.0 and second_arg <= 100:
             second_arg = second_arg / 100
         elif second_arg > 100:
-            opacity = 1.0
             raise ValueError(f"Opacity value is not a valid: {second_arg} (it should be less than 100%). Opacity will be set to 1.0...")
         opacity = second_arg
     except Exception as e:
-        opacity = 1.0
-        raise ValueError(f"Opacity value is not a valid: {second_arg}. opacity will be set to 1.0")
-
+        error = f"Opacity value is not a valid: {second_arg}. opacity will be set to 1.0"
 
     first_modifier = match.group(3).lower() if match.group(3) else None
     second_modifer:str = match.group(4).lower() if match.group(4) else None
@@ -375,41 +701,164 @@ def remap_key(match: re.Match) -> str:
         "type": None
     }
 
-    # print(second_modifer_name)
-
     if second_modifer and second_modifer_name in SECOND_MODIFIERS:
-        second_modifer_params = SECOND_MODIFIERS[second_modifer_name](second_modifer_raw_params)
+        try:
+            second_modifer_params = SECOND_MODIFIERS[second_modifer_name](second_modifer_raw_params)
+        except Exception as e:
+            error = error or str(e)
+
+    return KeyNode(first_arg, opacity, first_modifier, second_modifer_params, error)
+
+@functools.lru_cache(maxsize=4096)
+def parse_key_text(text: str) -> KeyNode:
+    """
+    Parses the KEY expression text (see parse_key). Themes repeat the same expressions a lot,
+    so the parsed KeyNodes are memoized and shared.
+    """
+    return parse_key(KEY_PATTERN.fullmatch(text))
+
+def evaluate_key(key: KeyNode, colors: dict) -> str:
+    """
+    Evaluates the parsed KEY expression with the given colors.
 
-    if (first_arg == "wallpaper" or first_arg == "w") and (opacity != 1.0 or first_modifier):
+    :param key: The parsed KEY expression.
+    :type key: KeyNode
+    :param colors: The colors mapped to Colors (see precompute_colors) or to rgb (see hex_to_rgb_map).
+    :type colors: dict
+    :return: The KEY replaced with the color in the requested format.
+    :rtype: str
+    """
+    first_arg_values = colors.get(key.color)
+    if not first_arg_values:
+        raise ValueError(f"Color '{key.color}' not found in the colors dictionary.")
+    if key.error:
+        raise ValueError(key.error)
+    if (key.color == "wallpaper" or key.color == "w") and (key.opacity != 1.0 or key.first_modifier):
         raise ValueError(f"You cant use opacity or modifier with wallpaper key.")
-    if first_modifier and first_modifier in FIRST_MODIFIERS:
-        return FIRST_MODIFIERS[first_modifier](first_arg_values, opacity, second_modifer_params)
-    return FIRST_MODIFIERS['DEFAULT'](first_arg_values, opacity)
+    if isinstance(first_arg_values, tuple):
+        first_arg_values = get_color(first_arg_values)
+    if key.first_modifier and key.first_modifier in FIRST_MODIFIERS:
+        if isinstance(first_arg_values, Color):
+            if not key.second_modifier["type"]:
+                return first_arg_values.to_string(key.first_modifier, key.opacity)
+            first_arg_values = first_arg_values.rgb
+        return FIRST_MODIFIERS[key.first_modifier](first_arg_values, key.opacity, key.second_modifier)
+    if isinstance(first_arg_values, Color):
+        return first_arg_values.to_string('DEFAULT', key.opacity)
+    return FIRST_MODIFIERS['DEFAULT'](first_arg_values, key.opacity)
+
+class KeyCache:
+    """
+    Memoizes evaluated KEY expressions for one palette, by their normalized expression (see KeyNode.cache_key).
+    It can be shared by threads: racing threads may evaluate the same KEY twice, and the hits and misses
+    are approximate then.
+    """
+    def __init__(self, colors: dict):
+        """
+        :param colors: The colors mapped to rgb (see hex_to_rgb_map).
+        :type colors: dict
+        """
+        self.colors = precompute_colors(colors)
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def evaluate(self, key: KeyNode) -> str:
+        """
+        Returns the evaluated KEY expression (see evaluate_key).
+        """
+        try:
+            value = self.values[key.cache_key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        self.misses += 1
+        value = self.values[key.cache_key] = evaluate_key(key, self.colors)
+        return value
+
+class Palette:
+    """
+    The colors of a palette mapped to rgb, with the KeyCache shared by every theme rendered with it.
+    A palette never changes, so it can be shared by renderers and threads.
+    """
+    def __init__(self, colors: dict):
+        """
+        :param colors: The colors mapped to rgb (see hex_to_rgb_map).
+        :type colors: dict
+        """
+        self.colors = colors
+        self.key_cache = KeyCache(colors)
+
+    @classmethod
+    def from_pywal(cls, pywal_colors: dict) -> "Palette":
+        """
+        Returns the palette of the colors in the format of pywal.
+        """
+        return cls(hex_to_rgb_map(map_colors(pywal_colors)))
+
+    @classmethod
+    def load(cls, source: str = None, use_cache: bool = True, backend: str = "pywal") -> "Palette":
+        """
+        Returns the palette of the source: a pywal json file, an image or None for the default pywal colors.json
+        (see get_colors).
+        """
+        return cls.from_pywal(get_colors(source, use_cache=use_cache, backend=backend) if source else get_colors_json())
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Palette) and self.colors == other.colors
+
+    @functools.cached_property
+    def version(self) -> str:
+        """
+        A short hash of the colors, the same for equal palettes.
+        """
+        return hashlib.sha1(json.dumps(self.colors, sort_keys=True).encode()).hexdigest()[:12]
+
+    def evaluate(self, key: KeyNode) -> str:
+        """
+        Returns the evaluated KEY expression, memoized (see KeyCache).
+        """
+        return self.key_cache.evaluate(key)
+
+def remap_key(match: re.Match, colors: dict) -> str:
+    """
+    Remaps the key to the css rgba format.
+
+    :param match: The match object to remap.
+    :type match: re.Match
+    :param colors: The colors mapped to rgb (see hex_to_rgb_map).
+    :type colors: dict
+    """
+    return evaluate_key(parse_key(match), colors)
 
-def replace_key(text: str) -> str:
+def replace_key(text: str, colors: dict) -> str:
     """
     Replaces the key with the rgba format.
 
     :param text: The text to replace the key in.
     :type text: str
+    :param colors: The colors mapped to rgb (see hex_to_rgb_map).
+    :type colors: dict
     :return: The text with the key replaced.
     :rtype: str
     """
-    return re.sub(r'KEY\((\w+)(?:,\s*(\d+(?:\.\d+)?))?\)(\.\w+)?(\.\w+(\(\d+(?:\.\d+)?(?:,\s*\d+(?:\.\d+)?)?\))?)?', remap_key, text, flags=re.IGNORECASE)
+    return KEY_PATTERN.sub(lambda match: remap_key(match, colors), text)
 
-def check_path(path: str, file_name: str = "") -> None:
+def check_path(path: str, file_name: str = "", theme_count: int = 1) -> None:
     """
     Checks if the path exists and if not creates it.
 
     :param path: The path to check.
     :param file_name: The name of the file to create if name dosent given.
+    :param theme_count: The number of theme files written to the path.
     :type path: str
     """
     if "~" in path: path = path.replace("~", HOME_PATH)
     if not os.path.exists(path):
         logging.info(f"(walcord) Path not found: {path}")
         if "." in path[1:]:
-            if len(theme_files_paths) > 1:
+            if theme_count > 1:
                 logging.error(f"(walcord) Error: You can't use multiple theme files with a single output file.")
                 sys.exit(-1)
             logging.info(f"(walcord) Creating file: {path}")
@@ -427,121 +876,2047 @@ def check_path(path: str, file_name: str = "") -> None:
                     pass
     logging.info(f"(walcord) Path checked: {path}")
 
-theme_files_paths = []
+def match_globs(path: str, include: list = None, exclude: list = None) -> bool:
+    """
+    Returns True if the path (or its file name) matches one of the include globs (if any) and none of the exclude globs.
+    """
+    def matches(globs):
+        return any(fnmatch.fnmatch(path, glob) or fnmatch.fnmatch(os.path.basename(path), glob) for glob in globs)
+    return (not include or matches(include)) and not (exclude and matches(exclude))
 
-def check_themes(theme: str) -> None:
+def check_themes(theme: str, include: list = None, exclude: list = None) -> list:
     """
     Checks if the theme file exists and make a list of theme files.
 
     :param theme: The path to the theme file to check.
     :type theme: str
+    :param include: Only take the files of a theme directory matching one of these globs.
+    :type include: list
+    :param exclude: Skip the files of a theme directory matching one of these globs.
+    :type exclude: list
+    :return: The theme file paths.
+    :rtype: list
     """
+    theme_files_paths = []
     logging.info(f"(walcord) checking theme path: {theme}")
     if "~" in theme: theme = theme.replace("~", HOME_PATH)
     if os.path.isfile(theme): # Check if path is a file
         theme_files_paths.append(theme)
     elif os.path.isdir(theme): # Check if path is a directory
         for root, dirs, files in os.walk(theme):
-            for file in files:
-                theme_files_paths.append(os.path.join(root, file))
+            dirs.sort()
+            for file in sorted(files):
+                if match_globs(os.path.relpath(os.path.join(root, file), theme).replace(os.sep, "/"), include, exclude):
+                    theme_files_paths.append(os.path.join(root, file))
     else: # Path is not a file or directory so error
         logging.error(f"(walcord) Error: Is not an existing file or directory: {theme}")
         sys.exit(-1)
     logging.info(f"(walcord) found {len(theme_files_paths)} theme files.")
+    return theme_files_paths
+
+class CompiledLine:
+    """
+    A theme line containing KEY expressions, split into literal text and KeyNodes.
+    """
+    __slots__ = ("segments", "parse_error")
+
+    def __init__(self, segments: list, parse_error: bool = False):
+        self.segments = segments
+        self.parse_error = parse_error
+
+def compile_line(line: str, end: str = ""):
+    """
+    Compiles a single theme line.
 
-def try_replace_key_in_theme(lines: dict, filename: str, end: str = "") -> str:
-    output = ""
-    for n, i in enumerate(lines):
-        if bool(re.search(r'KEY\([^)]*\)', i, re.IGNORECASE)):
+    :param line: The line to compile.
+    :type line: str
+    :param end: The string appended to the line after rendering.
+    :type end: str
+    :return: The line itself (with end) if it has no KEY, a CompiledLine otherwise.
+    """
+    if not KEY_PROBE_PATTERN.search(line):
+        return line + end
+    segments = []
+    pos = 0
+    for match in KEY_PATTERN.finditer(line):
+        if match.start() > pos:
+            segments.append(line[pos:match.start()])
+        segments.append(parse_key_text(match.group(0)))
+        pos = match.end()
+    if not segments:
+        return CompiledLine([line + end], parse_error=True)
+    segments.append(line[pos:] + end)
+    return CompiledLine(segments)
+
+def iter_compile_theme(lines, end: str = ""):
+    """
+    Compiles the theme lines one by one into literal lines and CompiledLines, so the theme can be
+    rendered with any palette without parsing it again.
+
+    :param lines: The lines of the theme (any iterable).
+    :param end: The string appended to every line after rendering.
+    :type end: str
+    :return: A generator of compiled lines.
+    """
+    for line in lines:
+        yield compile_line(line, end)
+
+def compile_theme(lines: list, end: str = "") -> list:
+    """
+    Compiles the theme lines (see iter_compile_theme).
+
+    :param lines: The lines of the theme.
+    :type lines: list
+    :param end: The string appended to every line after rendering.
+    :type end: str
+    :return: The compiled theme.
+    :rtype: list
+    """
+    return list(iter_compile_theme(lines, end))
+
+def iter_render_theme(template, palette: Palette, filename: str, file_stats: dict = None):
+    """
+    Renders the compiled theme line by line with the palette.
+
+    :param template: The compiled theme, any iterable of compiled lines (see iter_compile_theme).
+    :param palette: The palette to render with.
+    :type palette: Palette
+    :param filename: The name of the theme, used in log messages.
+    :type filename: str
+    :param file_stats: The --stats metrics of the file to count into (see RunStats.new_file), or None.
+    :type file_stats: dict
+    :return: A generator of rendered lines.
+    """
+    evaluate = palette.key_cache.evaluate
+    if file_stats is not None:
+        template = iter_measure_template(template, file_stats)
+    for n, line in enumerate(template):
+        if isinstance(line, str):
+            yield line
+            continue
+        try:
+            new_line = "".join(s if isinstance(s, str) else evaluate(s) for s in line.segments)
+        except Exception as e:
+            logging.error(f"(walcord) in line {n+1} in {filename}: {e}")
+            if file_stats is not None: file_stats["errors"] += 1
+            continue
+        if line.parse_error:
+            if file_stats is not None: file_stats["parse_errors"] += 1
+            logging.warning(f"(walcord) in line {n+1} in {filename}: KEY parse error. Maybe you wrote the wrong parameters?")
+        yield new_line
+
+def render_theme(template, palette: Palette, filename: str, file_stats: dict = None) -> str:
+    """
+    Renders the compiled theme with the palette.
+
+    :param template: The compiled theme (see compile_theme).
+    :param palette: The palette to render with.
+    :type palette: Palette
+    :param filename: The name of the theme, used in log messages.
+    :type filename: str
+    :param file_stats: The --stats metrics of the file to count into, or None.
+    :type file_stats: dict
+    :return: The rendered theme.
+    :rtype: str
+    """
+    return "".join(iter_render_theme(template, palette, filename, file_stats))
+
+def try_replace_key_in_theme(lines: dict, filename: str, palette: Palette, end: str = "") -> str:
+    return render_theme(iter_compile_theme(lines, end), palette, filename)
+
+def iter_replace_description(lines):
+    """
+    Replaces the @description of the theme with the walcord one.
+
+    :param lines: The lines of the theme (any iterable).
+    :return: A generator of the lines with the replaced description.
+    """
+    lines = iter(lines)
+    for line in lines:
+        if "@description" in line:
+            yield " * @description Generated by Walcord\n"
+            break
+        yield line
+    yield from lines
+
+def iter_split_lines(stream):
+    """
+    Reads the text stream line by line, yielding the same lines as stream.read().split("\n").
+    """
+    line = ""
+    for line in stream:
+        yield line[:-1] if line.endswith("\n") else line
+    if line == "" or line.endswith("\n"):
+        yield ""
+
+def dump_compiled_line(line):
+    """
+    Converts the compiled line to a json serializable value.
+    """
+    if isinstance(line, str):
+        return line
+    return {
+        "segments": [s if isinstance(s, str) else [s.color, s.opacity, s.first_modifier, s.second_modifier, s.error] for s in line.segments],
+        "parse_error": line.parse_error
+    }
+
+def load_compiled_line(dumped):
+    """
+    Converts the value made by dump_compiled_line back to the compiled line.
+    """
+    if isinstance(dumped, str):
+        return dumped
+    return CompiledLine([s if isinstance(s, str) else KeyNode(*s) for s in dumped["segments"]], dumped["parse_error"])
+
+def read_template_cache(cache_file: str, path: str, end: str):
+    """
+    Opens the template cache file and reads its header.
+
+    :return: The open cache file (positioned after the header) and the header, or (None, None) if there is no valid cache.
+    :rtype: tuple
+    """
+    try:
+        cache = open(cache_file)
+    except OSError:
+        return None, None
+    try:
+        header = json.loads(cache.readline())
+        if header.get("version") == TEMPLATE_CACHE_VERSION and header.get("path") == path and header.get("end") == end:
+            with contextlib.suppress(OSError): os.utime(cache_file) # mark as recently used (see evict_cache)
+            return cache, header
+    except ValueError as e:
+        logging.warning(f"(walcord) broken template cache {cache_file}: {e}")
+    cache.close()
+    return None, None
+
+def iter_write_template_cache(cache_file: str, header: dict, dumped_lines):
+    """
+    Writes the dumped lines to the template cache while passing them through. They are streamed to a
+    temporary file (unique per process and thread, see get_tmp_path) after the header, and the cache file
+    is replaced only when all lines were written. A failed write only stops the caching.
+    """
+    tmp_file = get_tmp_path(cache_file)
+    tmp = None
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp = open(tmp_file, "w")
+        tmp.write(json.dumps(header) + "\n")
+    except OSError as e:
+        logging.warning(f"(walcord) can't write template cache {cache_file}: {e}")
+    try:
+        for dumped in dumped_lines:
+            if tmp:
+                try:
+                    tmp.write(json.dumps(dumped) + "\n")
+                except OSError as e:
+                    logging.warning(f"(walcord) can't write template cache {cache_file}: {e}")
+                    with contextlib.suppress(OSError): tmp.close()
+                    tmp = None
+            yield dumped
+        if tmp:
+            tmp.close()
+            os.replace(tmp_file, cache_file)
+            evict_cache(TEMPLATE_CACHE_PATH, ".jsonl", TEMPLATE_CACHE_MAX_ENTRIES)
+    except OSError as e:
+        logging.warning(f"(walcord) can't write template cache {cache_file}: {e}")
+    finally:
+        if tmp:
+            tmp.close()
+        with contextlib.suppress(FileNotFoundError): os.remove(tmp_file)
+
+def iter_compiled_theme_file(path: str, end: str = "", use_cache: bool = True):
+    """
+    Compiles the theme file line by line. Compiled themes are cached in TEMPLATE_CACHE_PATH (a json header
+    and one json line per compiled line), keyed by the file path, its mtime and content hash, so unchanged
+    themes are never parsed again.
+
+    :param path: The path to the theme file.
+    :type path: str
+    :param end: The string appended to every line after rendering.
+    :type end: str
+    :param use_cache: Read and write the on-disk cache.
+    :type use_cache: bool
+    :return: A generator of compiled lines.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    cache_file = os.path.join(TEMPLATE_CACHE_PATH, hashlib.sha1(f"{path}{end}".encode()).hexdigest() + ".jsonl")
+    cache, header = read_template_cache(cache_file, path, end) if use_cache else (None, None)
+    try:
+        if header and header["mtime"] == stat.st_mtime_ns and header["size"] == stat.st_size:
+            logging.info(f"(walcord) using compiled theme from cache: {path}")
+            for line in cache:
+                yield load_compiled_line(json.loads(line))
+            return
+
+        content_hash = hash_file(path)
+        if header and header["hash"] == content_hash:
+            logging.info(f"(walcord) using compiled theme from cache: {path}")
+            dumped_lines = (json.loads(line) for line in cache)
+        else:
+            if cache: cache.close()
+            cache = open(path)
+            dumped_lines = (dump_compiled_line(line) for line in iter_compile_theme(iter_replace_description(cache), end))
+
+        if use_cache:
+            dumped_lines = iter_write_template_cache(cache_file, {
+                "version": TEMPLATE_CACHE_VERSION,
+                "path": path,
+                "end": end,
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "hash": content_hash
+            }, dumped_lines)
+        for dumped in dumped_lines:
+            yield load_compiled_line(dumped)
+    finally:
+        if cache: cache.close()
+
+def get_theme_file_name(theme_file: str, theme_lines: list = None, extention: str = None) -> str:
+    """
+    Returns the name of the generated theme file.
+
+    :param theme_file: The path to the theme file, "DEFAULT_THEME" or "STDIN_THEME".
+    :type theme_file: str
+    :param theme_lines: The lines of the stdin theme (only the ones with @name are needed).
+    :type theme_lines: list
+    :param extention: The extention of the stdin theme file.
+    :type extention: str
+    """
+    if theme_file == "DEFAULT_THEME":
+        return "walcord.theme.css"
+    elif theme_file == "STDIN_THEME":
+        theme_file_name = "stdin.walcord.theme.css"
+        for i in range(len(theme_lines)):
+            if "@name" in theme_lines[i]:
+                theme_file_name = theme_lines[i].split(" ")[-1].strip()
+                theme_file_name += ".css" if not extention else extention
+        return theme_file_name
+    return os.path.basename(theme_file)
+
+def get_output_path(theme_file_name: str, output: str = None) -> str:
+    """
+    Returns the path the generated theme file will be written to.
+
+    :param theme_file_name: The name of the generated theme file.
+    :type theme_file_name: str
+    :param output: The --output path.
+    :type output: str
+    """
+    output_path = output if output else os.path.join(ORIGIN_VESKTOP_THEME_PATH, theme_file_name)
+    if not "." in output_path[1:]: output_path = os.path.join(output_path, theme_file_name)
+    return output_path
+
+def iter_theme(theme_file: str, end: str = "", theme_lines = None, use_cache: bool = True):
+    """
+    Returns a generator of the compiled theme lines.
+
+    :param theme_file: The path to the theme file, "DEFAULT_THEME" or "STDIN_THEME".
+    :type theme_file: str
+    :param end: The string appended to every line after rendering.
+    :type end: str
+    :param theme_lines: The lines of the stdin theme (any iterable).
+    :param use_cache: Use the on-disk template cache.
+    :type use_cache: bool
+    """
+    if theme_file == "DEFAULT_THEME":
+        return iter_compile_theme(iter_replace_description(DEFAULT_THEME.split("\n")), end)
+    elif theme_file == "STDIN_THEME":
+        return iter_compile_theme(iter_replace_description(theme_lines), end)
+    return iter_compiled_theme_file(theme_file, end, use_cache=use_cache)
+
+def load_theme(theme_file: str, end: str = "", theme_lines: list = None, use_cache: bool = True) -> list:
+    """
+    Returns the compiled theme (see iter_theme).
+    """
+    return list(iter_theme(theme_file, end, theme_lines, use_cache))
+
+def get_tmp_path(path: str) -> str:
+    """
+    Returns a temporary path next to the given one, so it can be renamed over it.
+    The path is unique per process and thread. For a symlink, it is next to the file the link points to
+    (see replace_if_changed).
+    """
+    path = os.path.realpath(path)
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+def replace_if_changed(tmp_path: str, output_path: str) -> bool:
+    """
+    Renames the temporary file to the output path, unless the output already has the same content
+    (same size and sha256). Skipping unchanged themes avoids useless reloads in Vesktop.
+    A symlinked output is written through: the file it points to is replaced, and the link is kept.
+
+    :return: True if the output was written.
+    :rtype: bool
+    """
+    real_path = os.path.realpath(output_path)
+    if os.path.exists(real_path):
+        if os.path.getsize(real_path) == os.path.getsize(tmp_path) and hash_file(real_path) == hash_file(tmp_path):
+            os.remove(tmp_path)
+            logging.info(f"(walcord) {output_path} is unchanged, skipping.")
+            return False
+        shutil.copymode(real_path, tmp_path)
+    if os.path.dirname(tmp_path) != os.path.dirname(real_path):
+        # the temporary file was made before the output path was known (--stdin), maybe on another filesystem
+        moved_path = get_tmp_path(real_path)
+        shutil.move(tmp_path, moved_path)
+        tmp_path = moved_path
+    os.replace(tmp_path, real_path)
+    logging.info(f"(walcord) {output_path} generated successfully.")
+    return True
+
+def is_key_free(path: str) -> bool:
+    """
+    Returns True if the theme file is copied as is: a binary file (images, fonts), or a text file that
+    renders to itself, with no KEY, no @description and no \\r (see RENDER_BYTES_PATTERN).
+    The raw bytes are searched through mmap, so the file is never decoded.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return True
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return data.find(b"\0", 0, BINARY_PROBE_SIZE) != -1 or RENDER_BYTES_PATTERN.search(data) is None
+
+def copy_file(src: str, dst: str) -> None:
+    """
+    Copies the file inside the kernel: with copy_file_range (which can share the blocks on CoW filesystems),
+    falling back to sendfile, then to a plain copy.
+    """
+    with open(src, "rb") as source, open(dst, "wb") as target:
+        infd, outfd = source.fileno(), target.fileno()
+        size, offset = os.fstat(infd).st_size, 0
+        copies = []
+        if hasattr(os, "copy_file_range"):
+            copies.append(lambda count: os.copy_file_range(infd, outfd, count, offset, offset))
+        if hasattr(os, "sendfile"):
+            copies.append(lambda count: os.sendfile(outfd, infd, offset, count))
+        for copy in copies:
+            os.lseek(outfd, offset, os.SEEK_SET)
             try:
-                new_line = replace_key(i) + end
-                if new_line == i + end:
-                    logging.warning(f"(walcord) in line {n+1} in {filename}: KEY parse error. Maybe you wrote the wrong parameters?")
-                output += new_line
+                while offset < size:
+                    copied = copy(size - offset)
+                    if copied == 0:
+                        return
+                    offset += copied
+                return
+            except OSError:
+                continue
+        source.seek(offset)
+        target.seek(offset)
+        shutil.copyfileobj(source, target)
+
+def link_file(src: str, dst: str) -> str:
+    """
+    Creates dst with the content of src without copying it: as a hardlink, or as a reflink (FICLONE)
+    when the filesystem can't hardlink them.
+
+    :return: "hardlink", "reflink", or None if the filesystem allows neither.
+    :rtype: str
+    """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, "rb") as source, open(dst, "wb") as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        return "reflink"
+    except (ImportError, OSError):
+        if os.path.exists(dst): os.remove(dst)
+        return None
+
+class RunStats:
+    """
+    Wall times of the stages of a run and metrics of every rendered file (--stats).
+    The "render" stage includes reading and compiling the theme files, which are streamed.
+    """
+    def __init__(self):
+        self.stages = {"palette": 0.0, "themes": 0.0, "render": 0.0, "write": 0.0}
+        self.files = []
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - start
+
+    def new_file(self, theme_file: str, output_path: str = None) -> dict:
+        """
+        Returns the metrics of a theme file, filled while it is rendered and passed to add_file.
+        """
+        return {"file": theme_file, "output": output_path, "copied": False, "skipped": False, "bytes": 0, "lines": 0, "keys": 0, "parse_errors": 0, "errors": 0,
+                "seconds": 0.0, "render_seconds": 0.0, "write_seconds": 0.0}
+
+    def add_file(self, file_stats: dict) -> None:
+        file_stats["write_seconds"] = max(file_stats["seconds"] - file_stats["render_seconds"], 0.0)
+        if file_stats["output"] and os.path.isfile(file_stats["output"]):
+            file_stats["bytes"] = os.path.getsize(file_stats["output"])
+        with self.lock:
+            self.stages["render"] += file_stats["render_seconds"]
+            self.stages["write"] += file_stats["write_seconds"]
+            self.files.append(file_stats)
+
+    def to_dict(self) -> dict:
+        totals = {key: sum(file_stats[key] for file_stats in self.files) for key in ("bytes", "lines", "keys", "parse_errors", "errors")}
+        return {"version": VERSION, "seconds": time.perf_counter() - self.start, "stages": dict(self.stages), "totals": totals, "files": self.files}
+
+    def summary(self) -> str:
+        data = self.to_dict()
+        lines = ["walcord stats:"]
+        lines += [f"  {stage:<8} {seconds * 1000:10.2f} ms" for stage, seconds in data["stages"].items()]
+        lines.append(f"  {'total':<8} {data['seconds'] * 1000:10.2f} ms")
+        lines.append(f"  {'bytes':>10} {'lines':>8} {'keys':>8} {'parse':>6} {'errors':>6} {'ms':>10}  file")
+        for file_stats in self.files + [dict(data["totals"], file="(total)", seconds=sum(f["seconds"] for f in self.files))]:
+            lines.append(f"  {file_stats['bytes']:>10} {file_stats['lines']:>8} {file_stats['keys']:>8} {file_stats['parse_errors']:>6} {file_stats['errors']:>6} {file_stats['seconds'] * 1000:>10.2f}  {file_stats['file']}" + (" (copied)" if file_stats.get("copied") else "") + (" (up to date)" if file_stats.get("skipped") else ""))
+        return "\n".join(lines)
+
+def timed(stats: RunStats, stage: str):
+    """
+    Returns a context manager that adds its wall time to the stage of the stats,
+    or does nothing when stats is None (--stats is off).
+    """
+    return stats.timed(stage) if stats is not None else contextlib.nullcontext()
+
+def report_stats(stats: RunStats, path: str) -> None:
+    """
+    Prints the --stats summary, or writes the stats as json to the path ("-" for stdout).
+    """
+    if path is None:
+        print(stats.summary())
+    elif path == "-":
+        json.dump(stats.to_dict(), sys.stdout, indent=2)
+        print()
+    else:
+        with open(path, "w") as file: json.dump(stats.to_dict(), file, indent=2)
+        logging.info(f"(walcord) stats written to: {path}")
+
+def iter_measure_template(template, file_stats: dict):
+    """
+    Counts the lines and KEYs of the compiled theme into file_stats while it is rendered.
+    """
+    for line in template:
+        file_stats["lines"] += 1
+        if not isinstance(line, str):
+            file_stats["keys"] += sum(1 for s in line.segments if not isinstance(s, str))
+        yield line
+
+def iter_collect_keys(template, keys: set):
+    """
+    Adds the palette keys used by the KEYs of the compiled theme to keys while it is rendered.
+    """
+    for line in template:
+        if not isinstance(line, str):
+            keys.update(s.color for s in line.segments if not isinstance(s, str) and s.color is not None)
+        yield line
+
+def template_keys(template) -> set:
+    """
+    Returns the palette keys used by the KEYs of the compiled theme.
+    """
+    keys = set()
+    for line in iter_collect_keys(template, keys): pass
+    return keys
+
+def iter_timed(iterable, file_stats: dict):
+    """
+    Adds the time spent producing every item of the iterable to file_stats["render_seconds"].
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            file_stats["render_seconds"] += time.perf_counter() - start
+            return
+        file_stats["render_seconds"] += time.perf_counter() - start
+        yield item
+
+class RenderManifest:
+    """
+    Remembers, for every output, the theme file it was rendered from, the palette keys its KEYs use and
+    the colors of those keys, in MANIFEST_PATH. An output is only rendered again when one of its colors
+    changed, or when the theme file or the output itself changed since.
+    """
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self.outputs = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(path) as file:
+                data = json.load(file)
+            if data.get("version") == MANIFEST_VERSION and data.get("walcord") == VERSION:
+                self.outputs = data["outputs"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    @staticmethod
+    def stamp(path: str) -> list:
+        """
+        Returns the mtime and size of the file, or None for DEFAULT_THEME (it changes with VERSION only).
+        """
+        if path == "DEFAULT_THEME":
+            return None
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    @staticmethod
+    def color(colors: dict, key: str):
+        value = colors.get(key)
+        return list(value) if isinstance(value, tuple) else value
+
+    def is_up_to_date(self, theme_file: str, output_path: str, end: str, colors: dict) -> bool:
+        """
+        Returns True if the output was rendered from the unchanged theme file with the same colors for
+        every palette key the theme uses, and wasn't changed since.
+        """
+        entry = self.outputs.get(os.path.abspath(output_path))
+        if not entry or entry["theme"] != os.path.abspath(theme_file) or entry["end"] != end:
+            return False
+        try:
+            if entry["theme_stamp"] != self.stamp(theme_file) or entry["output_stamp"] != self.stamp(output_path):
+                return False
+        except OSError:
+            return False
+        return all(self.color(colors, key) == value for key, value in entry["colors"].items())
+
+    def record(self, theme_file: str, theme_stamp: list, output_path: str, end: str, keys: set, colors: dict) -> None:
+        """
+        Records the output just written, with the stamp of the theme file taken before it was read.
+        """
+        try:
+            output_stamp = self.stamp(output_path)
+        except OSError:
+            return
+        entry = {
+            "theme": os.path.abspath(theme_file),
+            "theme_stamp": theme_stamp,
+            "end": end,
+            "output_stamp": output_stamp,
+            "colors": {key: self.color(colors, key) for key in sorted(keys)}
+        }
+        with self.lock:
+            self.outputs[os.path.abspath(output_path)] = entry
+            self.dirty = True
+
+    def save(self) -> None:
+        """
+        Writes the manifest if it changed, without the outputs that don't exist anymore.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            outputs = {path: entry for path, entry in self.outputs.items() if os.path.exists(path)}
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = get_tmp_path(self.path)
+            with open(tmp_path, "w") as file:
+                json.dump({"version": MANIFEST_VERSION, "walcord": VERSION, "outputs": outputs}, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"(walcord) can't write the render manifest {self.path}: {e}")
+
+class Renderer:
+    """
+    Renders theme files with a palette and writes them. A renderer keeps its own palette, write counts
+    and --stats, so renderers with different palettes can run side by side, and one renderer can be
+    used by many threads. Assigning a new palette only changes the renders started after it.
+    """
+    def __init__(self, palette: Palette, end: str = "", use_cache: bool = True, stats: RunStats = None, manifest: RenderManifest = None, mirrors: list = None):
+        """
+        :param palette: The palette to render with.
+        :type palette: Palette
+        :param end: The string appended to every line after rendering.
+        :type end: str
+        :param use_cache: Use the on-disk template cache.
+        :type use_cache: bool
+        :param stats: The --stats to record into, or None.
+        :type stats: RunStats
+        :param manifest: The manifest to skip up to date outputs with and record the written ones into, or None.
+        :type manifest: RenderManifest
+        :param mirrors: More --output paths every output is also put in (see fan_out).
+        :type mirrors: list
+        """
+        self.palette = palette
+        self.end = end
+        self.use_cache = use_cache
+        self.stats = stats
+        self.manifest = manifest
+        self.mirrors = mirrors or []
+        self.write_stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    def load(self, theme_file: str, theme_lines = None) -> list:
+        """
+        Returns the compiled theme (see load_theme).
+        """
+        return load_theme(theme_file, self.end, theme_lines, self.use_cache)
+
+    def render(self, template, filename: str) -> str:
+        """
+        Renders the compiled theme (see render_theme).
+        """
+        return render_theme(template, self.palette, filename)
+
+    def render_file(self, theme_file: str) -> str:
+        """
+        Compiles and renders the theme file, "DEFAULT_THEME" included.
+        """
+        return render_theme(iter_theme(theme_file, self.end, use_cache=self.use_cache), self.palette, theme_file)
+
+    def generate(self, theme_file: str, template, output_path: str) -> bool:
+        """
+        Renders the compiled theme and writes it to the output path.
+
+        :param theme_file: The path to the theme file, used in log messages.
+        :type theme_file: str
+        :param template: The compiled theme, any iterable of compiled lines.
+        :param output_path: The path to write the theme to.
+        :type output_path: str
+        :return: True if the output was written, False if it was unchanged.
+        :rtype: bool
+        """
+        logging.info(f"(walcord) start to generate theme file...")
+        palette, stats, manifest = self.palette, self.stats, self.manifest
+        if stats is None and manifest is None:
+            return self.write(output_path, iter_render_theme(template, palette, theme_file))
+        if manifest is not None:
+            theme_stamp, keys = manifest.stamp(theme_file), set()
+            template = iter_collect_keys(template, keys)
+        if stats is None:
+            written = self.write(output_path, iter_render_theme(template, palette, theme_file))
+        else:
+            file_stats = stats.new_file(theme_file, output_path)
+            start = time.perf_counter()
+            try:
+                written = self.write(output_path, iter_timed(iter_render_theme(template, palette, theme_file, file_stats), file_stats))
+            finally:
+                file_stats["seconds"] = time.perf_counter() - start
+                stats.add_file(file_stats)
+        if manifest is not None:
+            manifest.record(theme_file, theme_stamp, output_path, self.end, keys, palette.colors)
+        return written
+
+    def is_up_to_date(self, theme_file: str, output_path: str) -> bool:
+        """
+        Returns True if the output doesn't need to be rendered again with the palette (see RenderManifest.is_up_to_date).
+        """
+        manifest = self.manifest
+        return manifest is not None and manifest.is_up_to_date(theme_file, output_path, self.end, self.palette.colors)
+
+    def skip(self, theme_file: str, output_path: str) -> None:
+        """
+        Counts the up to date output as unchanged (see is_up_to_date).
+        """
+        logging.info(f"(walcord) {output_path} is up to date, skipping.")
+        self.count_write(False)
+        if self.stats is not None:
+            file_stats = self.stats.new_file(theme_file, output_path)
+            file_stats["skipped"] = True
+            self.stats.add_file(file_stats)
+        self.fan_out(output_path)
+
+    def save_manifest(self) -> None:
+        if self.manifest is not None:
+            self.manifest.save()
+
+    def can_copy(self, theme_file: str) -> bool:
+        """
+        Returns True if the theme file can be copied to the output as is, instead of rendered (see is_key_free).
+        """
+        return not self.end and theme_file not in ("DEFAULT_THEME", "STDIN_THEME") and is_key_free(theme_file)
+
+    def copy(self, theme_file: str, output_path: str) -> bool:
+        """
+        Copies a theme file without KEYs to the output path (see can_copy and copy_file).
+
+        :return: True if the output was written, False if it was unchanged.
+        :rtype: bool
+        """
+        logging.info(f"(walcord) no KEY in {theme_file}, copying it to: {output_path}")
+        stats, manifest = self.stats, self.manifest
+        start = time.perf_counter()
+        tmp_path = get_tmp_path(output_path)
+        try:
+            theme_stamp = manifest.stamp(theme_file) if manifest is not None else None
+            copy_file(theme_file, tmp_path)
+            written = self.count_write(replace_if_changed(tmp_path, output_path))
+            if manifest is not None:
+                manifest.record(theme_file, theme_stamp, output_path, self.end, set(), self.palette.colors)
+            self.fan_out(output_path)
+            return written
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            if stats is not None:
+                file_stats = stats.new_file(theme_file, output_path)
+                file_stats["copied"] = True
+                file_stats["seconds"] = time.perf_counter() - start
+                stats.add_file(file_stats)
+
+    def write(self, output_path: str, theme_text) -> bool:
+        """
+        Writes the rendered theme (a string or an iterable of rendered lines) to a temporary file
+        and renames it to the output path, so a reader never sees a half-written theme
+        (see replace_if_changed).
+
+        :return: True if the output was written, False if it was unchanged.
+        :rtype: bool
+        """
+        logging.info(f"(walcord) writing theme file to: {output_path}")
+        tmp_path = get_tmp_path(output_path)
+        try:
+            with open(tmp_path, "w") as file: file.writelines(theme_text)
+            written = self.count_write(replace_if_changed(tmp_path, output_path))
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        self.fan_out(output_path)
+        return written
+
+    def get_mirror_paths(self, output_path: str) -> list:
+        """
+        Returns the paths the output is also put in, one per mirror --output path.
+        """
+        return [path for path in (get_output_path(os.path.basename(output_path), mirror) for mirror in self.mirrors) if path != output_path]
+
+    def fan_out(self, output_path: str) -> None:
+        """
+        Puts the output at every mirror path without rendering it again: as a hardlink or a reflink
+        (see link_file), or by writing its content, read once, where the filesystem allows neither.
+        A mirror with other permissions than the output is never hardlinked, because keeping its mode
+        (see replace_if_changed) would change the mode of the output too.
+        Every mirror path is replaced atomically, and only if its content changed (see replace_if_changed).
+        """
+        content = None
+        source_path = os.path.realpath(output_path) # links the file of a symlinked output, not the symlink
+        source_mode = os.stat(source_path).st_mode & 0o7777
+        for mirror_path in self.get_mirror_paths(output_path):
+            if os.path.exists(mirror_path) and os.path.samefile(output_path, mirror_path):
+                logging.info(f"(walcord) {mirror_path} is unchanged, skipping.")
+                self.count_write(False)
+                continue
+            tmp_path = get_tmp_path(mirror_path)
+            try:
+                same_mode = not os.path.exists(mirror_path) or os.stat(mirror_path).st_mode & 0o7777 == source_mode
+                method = link_file(source_path, tmp_path) if same_mode else None
+                if method is None:
+                    if content is None:
+                        with open(source_path, "rb") as file: content = file.read()
+                    with open(tmp_path, "wb") as file: file.write(content)
+                    method = "copy"
+                logging.info(f"(walcord) writing theme file to: {mirror_path} ({method})")
+                self.count_write(replace_if_changed(tmp_path, mirror_path))
+            except OSError as e:
+                logging.error(f"(walcord) can't write {mirror_path}: {e}")
+            finally:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    def count_write(self, written: bool) -> bool:
+        with self.lock:
+            self.write_stats["written" if written else "unchanged"] += 1
+        return written
+
+    def generate_stdin(self, lines, output: str = None, extention: str = None) -> bool:
+        """
+        Renders the theme read from stdin as it arrives. The output name depends on the @name of the
+        theme, so it is streamed to a temporary file that is renamed when the whole theme is read.
+
+        :param lines: The lines of the theme (see iter_split_lines).
+        :param output: The --output path.
+        :type output: str
+        :param extention: The extention of the theme file.
+        :type extention: str
+        :return: True if the output was written, False if it was unchanged.
+        :rtype: bool
+        """
+        name_lines = []
+        def collect_names(lines):
+            for line in lines:
+                if "@name" in line: name_lines.append(line)
+                yield line
+
+        tmp_path = get_tmp_path(get_output_path(get_theme_file_name("STDIN_THEME", [], extention), output))
+        stats = self.stats
+        file_stats = stats.new_file("STDIN_THEME") if stats is not None else None
+        start = time.perf_counter()
+        logging.info(f"(walcord) start to generate theme file...")
+        try:
+            rendered = iter_render_theme(iter_theme("STDIN_THEME", self.end, collect_names(lines)), self.palette, "STDIN_THEME", file_stats)
+            with open(tmp_path, "w") as file:
+                file.writelines(rendered if file_stats is None else iter_timed(rendered, file_stats))
+            output_path = get_output_path(get_theme_file_name("STDIN_THEME", name_lines, extention), output)
+            logging.info(f"(walcord) writing theme file to: {output_path}")
+            if file_stats is not None: file_stats["output"] = output_path
+            written = self.count_write(replace_if_changed(tmp_path, output_path))
+            self.fan_out(output_path)
+            return written
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            if file_stats is not None:
+                file_stats["seconds"] = time.perf_counter() - start
+                stats.add_file(file_stats)
+
+    def log_key_cache_stats(self) -> None:
+        """
+        Logs the hits and misses of the KeyCache of the palette.
+        """
+        key_cache = self.palette.key_cache
+        logging.info(f"(walcord) KEY cache: {key_cache.hits} hits, {key_cache.misses} misses.")
+
+    def log_write_stats(self) -> None:
+        """
+        Logs how many theme files were written and how many were unchanged.
+        """
+        logging.info(f"(walcord) {self.write_stats['written']} files written, {self.write_stats['unchanged']} unchanged.")
+
+class RecordCollector(logging.Handler):
+    """
+    Collects the log records of a render worker, so they can be logged by the main process in order.
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        record.msg = record.getMessage()
+        record.args = None
+        self.records.append(record)
+
+worker_renderer = None # the Renderer of a render worker process, set by init_render_worker
+
+def init_render_worker(colors: dict, end: str, use_cache: bool, level: int) -> None:
+    """
+    Initializes the render worker process with the palette, the options and the log level of the main process.
+    """
+    global worker_renderer
+    worker_renderer = Renderer(Palette(colors), end, use_cache)
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.setLevel(level)
+
+def render_theme_job(theme_file: str, collect_stats: bool = False, collect_keys: bool = False) -> tuple:
+    """
+    Compiles and renders the theme file in a render worker.
+
+    :return: The rendered theme (None if it failed), the log records, the KEY cache hits and misses,
+        the --stats metrics (None if collect_stats is False) and the palette keys used by the theme
+        (None if collect_keys is False) of the job.
+    :rtype: tuple
+    """
+    file_stats = RunStats().new_file(theme_file) if collect_stats else None
+    keys = set() if collect_keys else None
+    start = time.perf_counter()
+    renderer = worker_renderer
+    cache = renderer.palette.key_cache
+    hits, misses = cache.hits, cache.misses
+    collector = RecordCollector()
+    logger = logging.getLogger()
+    logger.addHandler(collector)
+    try:
+        logging.info(f"(walcord) working on the file: {theme_file}")
+        template = iter_theme(theme_file, renderer.end, use_cache=renderer.use_cache)
+        if keys is not None:
+            template = iter_collect_keys(template, keys)
+        logging.info(f"(walcord) start to generate theme file...")
+        theme_text = render_theme(template, renderer.palette, theme_file, file_stats)
+    except Exception as e:
+        logging.error(f"(walcord) can't generate theme from {theme_file}: {e}")
+        theme_text = None
+    finally:
+        logger.removeHandler(collector)
+    if file_stats is not None:
+        file_stats["render_seconds"] = time.perf_counter() - start
+    return theme_text, collector.records, (cache.hits - hits, cache.misses - misses), file_stats, keys
+
+def render_themes_parallel(renderer: Renderer, outputs: list, jobs: int) -> None:
+    """
+    Renders the theme files on a pool of worker processes and writes them in the given order,
+    so the output (and the log) is the same as with a single job.
+
+    :param renderer: The renderer with the palette and the options of the workers, which writes the themes.
+    :type renderer: Renderer
+    :param outputs: The (theme file, output path) pairs.
+    :type outputs: list
+    :param jobs: The number of worker processes.
+    :type jobs: int
+    """
+    logging.info(f"(walcord) rendering {len(outputs)} theme files with {jobs} jobs...")
+    cache, stats, manifest = renderer.palette.key_cache, renderer.stats, renderer.manifest
+    import concurrent.futures
+    initargs = (renderer.palette.colors, renderer.end, renderer.use_cache, logging.getLogger().level)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_render_worker, initargs=initargs) as pool:
+        pending = []
+        for theme_file, output_path in outputs:
+            try:
+                if renderer.is_up_to_date(theme_file, output_path):
+                    pending.append(("skip", None, None))
+                elif renderer.can_copy(theme_file):
+                    pending.append(("copy", None, None))
+                else:
+                    theme_stamp = manifest.stamp(theme_file) if manifest is not None else None
+                    pending.append(("render", theme_stamp, pool.submit(render_theme_job, theme_file, stats is not None, manifest is not None)))
+            except (OSError, UnicodeDecodeError) as e: # an unreadable file or a broken symlink, logged in order below
+                pending.append(("error", None, e))
+        for (theme_file, output_path), (action, theme_stamp, future) in zip(outputs, pending):
+            if action == "error":
+                logging.info(f"(walcord) working on the file: {theme_file}")
+                logging.error(f"(walcord) can't generate theme from {theme_file}: {future}")
+                continue
+            if action != "render":
+                logging.info(f"(walcord) working on the file: {theme_file}")
+                try:
+                    if action == "skip":
+                        renderer.skip(theme_file, output_path)
+                    else:
+                        renderer.copy(theme_file, output_path)
+                except OSError as e:
+                    logging.error(f"(walcord) can't write {output_path}: {e}")
+                continue
+            try:
+                theme_text, records, (hits, misses), file_stats, keys = future.result()
             except Exception as e:
-                logging.error(f"(walcord) in line {n+1} in {filename}: {e}")
+                logging.error(f"(walcord) can't generate theme from {theme_file}: {e}")
+                continue
+            for record in records:
+                logging.getLogger().handle(record)
+            cache.hits += hits
+            cache.misses += misses
+            if theme_text is None:
+                continue
+            start = time.perf_counter()
+            try:
+                renderer.write(output_path, theme_text)
+                if keys is not None:
+                    manifest.record(theme_file, theme_stamp, output_path, renderer.end, keys, renderer.palette.colors)
+            except OSError as e:
+                logging.error(f"(walcord) can't write {output_path}: {e}")
+            if file_stats is not None:
+                file_stats["output"] = output_path
+                file_stats["seconds"] = file_stats["render_seconds"] + time.perf_counter() - start
+                stats.add_file(file_stats)
+
+def load_palette(args: argparse.Namespace) -> Palette:
+    """
+    Returns the palette of the --json/--image source (or the default pywal colors.json).
+    """
+    logging.info(f"(walcord) gettings colors...")
+    if args.json:
+        colors = get_colors_json(args.json)
+    else:
+        colors = get_colors_image(args.image, use_cache=not args.no_cache, backend=args.backend) if args.image else get_colors_json()
+    return Palette.from_pywal(colors)
+
+def get_colors(source: str, use_cache: bool = True, backend: str = "pywal") -> dict:
+    """
+    Returns a dictionary of colors from the palette source: a pywal json file or an image.
+
+    :param source: The path to the json file or the image.
+    :type source: str
+    :param use_cache: Use the palette cache for images.
+    :type use_cache: bool
+    :param backend: The name of the image backend (see IMAGE_BACKENDS).
+    :type backend: str
+    :return: A dictionary of colors in the format of pywal.
+    :rtype: dict
+    """
+    if source.endswith(".json"):
+        return get_colors_json(source)
+    return get_colors_image(source, use_cache=use_cache, backend=backend)
+
+def get_palette_names(sources: list) -> list:
+    """
+    Returns unique directory names for the palette sources (the file names without extention).
+    """
+    names = []
+    for source in sources:
+        name = os.path.splitext(os.path.basename(source))[0] or "palette"
+        unique_name, n = name, 2
+        while unique_name in names:
+            unique_name, n = f"{name}-{n}", n + 1
+        names.append(unique_name)
+    return names
+
+def expand_batch_sources(sources: list) -> list:
+    """
+    Replaces the @file entries of the --batch sources with the sources listed in the file, one per line.
+
+    :param sources: The --batch arguments.
+    :type sources: list
+    :return: The palette sources.
+    :rtype: list
+    """
+    expanded = []
+    for source in sources:
+        if source.startswith("@"):
+            with open(source[1:]) as file:
+                expanded.extend(line.strip() for line in file if line.strip())
         else:
-            output += i + end
-    
-    return output
+            expanded.append(source)
+    return expanded
+
+def compile_themes(renderer: Renderer, theme_files: list, stats: RunStats = None) -> list:
+    """
+    Compiles the theme files once, to be rendered with many palettes (--batch, --transition).
+    Files that can be copied as is (see Renderer.can_copy) are not compiled.
+
+    :param renderer: The renderer the themes are rendered with.
+    :type renderer: Renderer
+    :param theme_files: The theme file paths (or "DEFAULT_THEME").
+    :type theme_files: list
+    :param stats: The --stats to record into, or None.
+    :type stats: RunStats
+    :return: A list of (theme file, theme file name, compiled theme or None for a file to copy).
+    :rtype: list
+    """
+    templates = []
+    with timed(stats, "compile"):
+        for theme_file in theme_files:
+            try:
+                template = None if renderer.can_copy(theme_file) else load_theme(theme_file, renderer.end, use_cache=renderer.use_cache)
+                templates.append((theme_file, get_theme_file_name(theme_file), template))
+            except (OSError, UnicodeDecodeError) as e:
+                logging.error(f"(walcord) can't generate theme from {theme_file}: {e}")
+    return templates
+
+def run_batch(sources: list, theme_files: list, end: str, output: str, use_cache: bool = True, backend: str = "pywal", stats: RunStats = None) -> Renderer:
+    """
+    Renders every theme with every palette into output/<palette name>/<theme file name>.
+    The themes are compiled once and rendered with each palette.
+
+    :param sources: The palette sources (pywal json files or images).
+    :type sources: list
+    :param theme_files: The theme file paths (or "DEFAULT_THEME").
+    :type theme_files: list
+    :param end: The string appended to every line after rendering.
+    :type end: str
+    :param output: The output directory.
+    :type output: str
+    :param use_cache: Use the on-disk caches.
+    :type use_cache: bool
+    :param backend: The name of the image backend (see IMAGE_BACKENDS).
+    :type backend: str
+    :param stats: The --stats to record into, or None.
+    :type stats: RunStats
+    :return: The renderer used for every palette, with the write counts of the batch.
+    :rtype: Renderer
+    """
+    renderer = Renderer(None, end, use_cache, stats, RenderManifest() if use_cache else None)
+    templates = compile_themes(renderer, theme_files, stats)
+
+    with timed(stats, "palette"):
+        palettes = [Palette.load(source, use_cache=use_cache, backend=backend) for source in sources]
+    logging.info(f"(walcord) rendering {len(templates)} theme files with {len(palettes)} palettes...")
+    for name, palette in zip(get_palette_names(sources), palettes):
+        renderer.palette = palette
+        directory = os.path.join(output, name)
+        os.makedirs(directory, exist_ok=True)
+        for theme_file, theme_file_name, template in templates:
+            output_path = os.path.join(directory, theme_file_name)
+            try:
+                if renderer.is_up_to_date(theme_file, output_path):
+                    renderer.skip(theme_file, output_path)
+                elif template is None:
+                    renderer.copy(theme_file, output_path)
+                else:
+                    renderer.generate(theme_file, template, output_path)
+            except OSError as e:
+                logging.error(f"(walcord) can't write {output_path}: {e}")
+        renderer.log_key_cache_stats()
+    renderer.save_manifest()
+    return renderer
+
+def rgb_to_hls_array(rgb):
+    """
+    Converts an (..., 3) numpy array of rgb colors (0-255) to hls, like rgb_to_hls (colorsys) does.
+    """
+    import numpy
+    r, g, b = numpy.moveaxis(rgb / 255.0, -1, 0)
+    maxc, minc = numpy.maximum(numpy.maximum(r, g), b), numpy.minimum(numpy.minimum(r, g), b)
+    sumc, rangec = maxc + minc, maxc - minc
+    l = sumc / 2.0
+    gray = rangec == 0
+    safe_range = numpy.where(gray, 1.0, rangec)
+    s = numpy.where(gray, 0.0, numpy.where(l <= 0.5, rangec / numpy.where(gray, 1.0, sumc), rangec / numpy.where(gray, 1.0, 2.0 - sumc)))
+    rc, gc, bc = (maxc - r) / safe_range, (maxc - g) / safe_range, (maxc - b) / safe_range
+    h = numpy.where(r == maxc, bc - gc, numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = numpy.where(gray, 0.0, (h / 6.0) % 1.0)
+    return numpy.stack([h, l, s], axis=-1)
+
+def hls_to_rgb_array(hls):
+    """
+    Converts an (..., 3) numpy array of hls colors back to rgb (0-255 floats), like colorsys.hls_to_rgb does.
+    """
+    import numpy
+    h, l, s = numpy.moveaxis(hls, -1, 0)
+    m2 = numpy.where(l <= 0.5, l * (1.0 + s), l + s - l * s)
+    m1 = 2.0 * l - m2
+    def channel(hue):
+        hue = hue % 1.0
+        return numpy.where(hue < 1 / 6, m1 + (m2 - m1) * hue * 6.0,
+               numpy.where(hue < 0.5, m2,
+               numpy.where(hue < 2 / 3, m1 + (m2 - m1) * (2 / 3 - hue) * 6.0, m1)))
+    rgb = numpy.stack([channel(h + 1 / 3), channel(h), channel(h - 1 / 3)], axis=-1)
+    return numpy.where((s == 0)[..., None], l[..., None], rgb) * 255.0
+
+def interpolate_palettes(old: Palette, new: Palette, frames: int, space: str = "rgb") -> list:
+    """
+    Returns the palettes of a transition from the old palette to the new one. The colors are interpolated
+    in rgb, or in hls (the hue goes the short way around) at once as numpy arrays.
+    The last frame is the new palette.
+
+    :param old: The palette to start from.
+    :type old: Palette
+    :param new: The palette to end with.
+    :type new: Palette
+    :param frames: The number of frames.
+    :type frames: int
+    :param space: "rgb" or "hls".
+    :type space: str
+    :return: The palettes of the frames.
+    :rtype: list
+    :raises ImportError: If space is "hls" and numpy is missing.
+    """
+    keys = [key for key, value in new.colors.items() if isinstance(value, tuple) and isinstance(old.colors.get(key), tuple)]
+
+    if space == "hls":
+        try:
+            import numpy
+        except ImportError as e:
+            raise ImportError(f"--space hls needs numpy ({e}).") from e
+        start = numpy.array([old.colors[key] for key in keys], dtype=numpy.float64).reshape(-1, 3)
+        end = numpy.array([new.colors[key] for key in keys], dtype=numpy.float64).reshape(-1, 3)
+        steps = (numpy.arange(1, frames + 1, dtype=numpy.float64) / frames)[:, None, None] # (frames, 1, 1)
+        start, end = rgb_to_hls_array(start), rgb_to_hls_array(end)
+        # a gray has no hue: take the one of the other end, so it doesn't swing through the wheel
+        start[:, 0] = numpy.where(start[:, 2] == 0, end[:, 0], start[:, 0])
+        end[:, 0] = numpy.where(end[:, 2] == 0, start[:, 0], end[:, 0])
+        delta = end - start
+        delta[:, 0] = (delta[:, 0] + 0.5) % 1.0 - 0.5
+        colors = numpy.clip(numpy.rint(hls_to_rgb_array(start + delta * steps)), 0, 255).astype(numpy.int64).tolist()
+    else:
+        # a few dozen colors, interpolated without numpy (round() rounds halves to even, like numpy.rint)
+        colors = [[[min(max(round(a + (b - a) * (n / frames)), 0), 255) for a, b in zip(old.colors[key], new.colors[key])] for key in keys]
+                  for n in range(1, frames + 1)]
+
+    palettes = []
+    for frame_colors in colors:
+        palette_colors = dict(new.colors)
+        palette_colors.update(zip(keys, map(tuple, frame_colors)))
+        palettes.append(Palette(palette_colors))
+    return palettes
+
+def run_transition(old: Palette, new: Palette, frames: int, space: str, theme_files: list, end: str, output: str, use_cache: bool = True, stats: RunStats = None) -> Renderer:
+    """
+    Renders the themes for every frame of the transition from the old palette to the new one into
+    output/<frame number>/<theme file name>. The themes are compiled once and rendered with each frame.
+
+    :param old: The palette to start from.
+    :type old: Palette
+    :param new: The palette to end with.
+    :type new: Palette
+    :param frames: The number of frames.
+    :type frames: int
+    :param space: The color space to interpolate in (see interpolate_palettes).
+    :type space: str
+    :param theme_files: The theme file paths (or "DEFAULT_THEME").
+    :type theme_files: list
+    :param end: The string appended to every line after rendering.
+    :type end: str
+    :param output: The output directory.
+    :type output: str
+    :param use_cache: Use the on-disk template cache.
+    :type use_cache: bool
+    :param stats: The --stats to record into, or None.
+    :type stats: RunStats
+    :return: The renderer used for every frame, with the write counts of the transition.
+    :rtype: Renderer
+    """
+    renderer = Renderer(None, end, use_cache, stats)
+    templates = compile_themes(renderer, theme_files, stats)
+
+    with timed(stats, "palette"):
+        palettes = interpolate_palettes(old, new, frames, space)
+    logging.info(f"(walcord) rendering {len(templates)} theme files for {frames} frames ({space})...")
+    start = time.perf_counter()
+    width = len(str(frames))
+    for n, palette in enumerate(palettes, 1):
+        renderer.palette = palette
+        directory = os.path.join(output, f"{n:0{width}d}")
+        os.makedirs(directory, exist_ok=True)
+        for theme_file, theme_file_name, template in templates:
+            output_path = os.path.join(directory, theme_file_name)
+            try:
+                if template is None:
+                    renderer.copy(theme_file, output_path)
+                else:
+                    renderer.generate(theme_file, template, output_path)
+            except OSError as e:
+                logging.error(f"(walcord) can't write {output_path}: {e}")
+    seconds = time.perf_counter() - start
+    logging.info(f"(walcord) {frames} frames rendered in {seconds * 1000:.1f} ms ({seconds * 1000 / frames:.2f} ms per frame).")
+    return renderer
+
+def find_images(directory: str) -> list:
+    """
+    Returns the images (see IMAGE_EXTENSIONS) in the directory and its subdirectories, sorted.
+    """
+    images = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        images.extend(os.path.join(root, file) for file in sorted(files) if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS)
+    return images
+
+def prewarm_palette(image_path: str, backend: str) -> str:
+    """
+    Extracts the palette of the image into the palette cache in a --prewarm worker, unless it's already there.
+
+    :return: "cached" or "extracted".
+    :rtype: str
+    """
+    if os.path.exists(get_palette_cache_file(image_path, backend)):
+        return "cached"
+    get_colors_image(image_path, use_cache=True, backend=backend)
+    return "extracted"
+
+def run_prewarm(directory: str, backend: str = "pywal", jobs: int = 1) -> None:
+    """
+    Extracts the palettes of every image in the directory into the palette cache on a pool of worker
+    processes at a lowered priority, so switching to any of these wallpapers later doesn't wait for an extraction.
+
+    :param directory: The wallpaper directory.
+    :type directory: str
+    :param backend: The name of the image backend (see IMAGE_BACKENDS).
+    :type backend: str
+    :param jobs: The number of worker processes.
+    :type jobs: int
+    """
+    images = find_images(directory)
+    if hasattr(os, "nice"):
+        os.nice(PREWARM_NICENESS) # inherited by the workers
+    logging.info(f"(walcord) prewarming the palettes of {len(images)} images with {jobs} jobs...")
+    results = collections.Counter()
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(prewarm_palette, image_path, backend): image_path for image_path in images}
+        for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            image_path = futures[future]
+            try:
+                result = future.result()
+            except (Exception, SystemExit) as e: # the backends exit when they can't run
+                logging.error(f"(walcord) can't extract the palette of {image_path}: {e}")
+                result = "failed"
+            results[result] += 1
+            logging.info(f"(walcord) [{n}/{len(images)}] {image_path}: {result}")
+    logging.info(f"(walcord) {results['extracted']} palettes extracted, {results['cached']} already cached, {results['failed']} failed.")
+
+def iter_frames(stream, framing: str = "length"):
+    """
+    Reads the documents of a --stream from the binary stream as they arrive.
+    With "length" framing, every document is a json header line ({"length": <bytes>, "name": ..., "extention": ...},
+    name and extention are optional) followed by the document. With "nul" framing, the documents are separated by NUL bytes.
+
+    :return: A generator of (header, document bytes).
+    :raises ValueError: If a header is not valid or the stream ends inside a document.
+    """
+    if framing == "nul":
+        parts = [] # the chunks of the document being read, so only new chunks are searched and copied
+        for chunk in iter(lambda: stream.read1(STREAM_CHUNK_SIZE), b""):
+            start, end = 0, chunk.find(b"\0")
+            while end != -1:
+                parts.append(chunk[start:end])
+                yield {}, b"".join(parts)
+                parts = []
+                start, end = end + 1, chunk.find(b"\0", end + 1)
+            if start < len(chunk):
+                parts.append(chunk[start:])
+        if parts:
+            yield {}, b"".join(parts)
+        return
+    for line in iter(stream.readline, b""):
+        if not line.strip():
+            continue
+        header = json.loads(line)
+        if not isinstance(header, dict):
+            raise ValueError(f"the frame header is not a json object: {line.strip()[:80]!r}")
+        length = header.get("length")
+        if not isinstance(length, int) or isinstance(length, bool) or length < 0:
+            raise ValueError(f"the frame length is not a non-negative integer: {length!r}")
+        for field in ("name", "extention"):
+            if not isinstance(header.get(field, ""), str):
+                raise ValueError(f"the frame {field} is not a string: {header[field]!r}")
+        document = stream.read(length)
+        if len(document) < length:
+            raise ValueError(f"the stream ended {length - len(document)} bytes before the end of the document")
+        yield header, document
+
+def write_frame(stream, framing: str, header: dict, document: bytes) -> None:
+    """
+    Writes a document to the binary stream with the framing of iter_frames, and flushes it.
+    """
+    if framing == "nul":
+        stream.write(document + b"\0")
+    else:
+        stream.write(json.dumps(dict(header, length=len(document))).encode() + b"\n" + document)
+    stream.flush()
+
+def run_stream(renderer: Renderer, stream_in, stream_out, framing: str = "length", output: str = None, extention: str = None) -> None:
+    """
+    Renders every document of the input stream as it arrives, like --stdin renders one (see iter_frames),
+    and writes it to the output stream with the same framing, or to its file in the output path.
+
+    :param renderer: The renderer to render the documents with.
+    :type renderer: Renderer
+    :param stream_in: The binary stream to read the documents from.
+    :param stream_out: The binary stream to write the rendered documents (or, with an output path, the written paths) to.
+    :param framing: "length" or "nul".
+    :type framing: str
+    :param output: The --output path to write the documents to, or None to write them to the output stream.
+    :type output: str
+    :param extention: The extention of the documents without one in their header.
+    :type extention: str
+    """
+    count = 0
+    for header, document in iter_frames(stream_in, framing):
+        count += 1
+        response = {"ok": True}
+        rendered = b""
+        try:
+            lines = document.decode().split("\n")
+            if header.get("name"):
+                name = header["name"] + (header.get("extention") or extention or ".css")
+            else:
+                name = get_theme_file_name("STDIN_THEME", [line for line in lines if "@name" in line], header.get("extention") or extention)
+            logging.info(f"(walcord) working on the document {count}: {name}")
+            text = render_theme(iter_theme("STDIN_THEME", renderer.end, lines), renderer.palette, name)
+            response["name"] = name
+            if output:
+                response["path"] = get_output_path(name, output)
+                renderer.write(response["path"], text)
+            else:
+                rendered = text.encode()
+        except (UnicodeDecodeError, OSError) as e:
+            logging.error(f"(walcord) can't render the document {count}: {e}")
+            response = {"ok": False, "error": str(e)}
+        write_frame(stream_out, framing, response, rendered)
+    logging.info(f"(walcord) {count} documents rendered.")
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class InotifyWatcher:
+    """
+    Watches directories with inotify (linux only, through libc with ctypes).
+    """
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.recursive = set()
+
+    @staticmethod
+    def available() -> bool:
+        import ctypes.util
+        try:
+            return sys.platform.startswith("linux") and hasattr(ctypes.CDLL(ctypes.util.find_library("c")), "inotify_init1")
+        except OSError:
+            return False
+
+    def watch(self, path: str, recursive: bool = False) -> None:
+        """
+        Starts watching the directory (and its subdirectories if recursive).
+        """
+        import ctypes
+        directories = [root for root, dirs, files in os.walk(path)] if recursive else [path]
+        for directory in directories:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                logging.warning(f"(walcord) can't watch {directory}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.watches[wd] = directory
+            if recursive: self.recursive.add(directory)
+
+    def read(self, timeout: float = None) -> set:
+        """
+        Waits for events up to timeout seconds and returns the set of changed paths.
+        """
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+            offset += INOTIFY_EVENT.size + length
+            if wd not in self.watches:
+                continue
+            path = os.path.normpath(os.path.join(self.watches[wd], os.fsdecode(name)))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self.watches[wd] in self.recursive:
+                    self.watch(path, recursive=True)
+                    changed.update(os.path.normpath(os.path.join(root, file)) for root, dirs, files in os.walk(path) for file in files)
+                continue
+            changed.add(path)
+        return changed
+
+class PollingWatcher:
+    """
+    Watches directories by polling mtimes, for systems without inotify.
+    """
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.directories = {}
+        self.snapshot = {}
+
+    def watch(self, path: str, recursive: bool = False) -> None:
+        self.directories[path] = recursive
+        self.snapshot = self.scan()
+
+    def scan(self) -> dict:
+        snapshot = {}
+        for directory, recursive in self.directories.items():
+            for root, dirs, files in os.walk(directory):
+                for file in files:
+                    path = os.path.normpath(os.path.join(root, file))
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+                if not recursive:
+                    break
+        return snapshot
+
+    def read(self, timeout: float = None) -> set:
+        waited = 0.0
+        while True:
+            snapshot = self.scan()
+            changed = {path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changed or (timeout is not None and waited >= timeout):
+                return changed
+            time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+            waited += self.interval if timeout is None else min(self.interval, timeout)
+
+def wait_for_changes(watcher, debounce: float = SERVICE_DEBOUNCE) -> set:
+    """
+    Blocks until something changes, then collects events until nothing changes for debounce seconds,
+    so a burst of writes is handled once.
+    """
+    changed = watcher.read(None)
+    while True:
+        more = watcher.read(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+def run_service(args: argparse.Namespace, renderer: Renderer, theme_files: list, templates: dict) -> None:
+    """
+    Keeps the compiled themes in memory and re-renders them when the palette or the theme files change.
+
+    :param args: The parsed command line arguments.
+    :type args: argparse.Namespace
+    :param renderer: The renderer of the first run. Its palette is replaced when the palette source changes.
+    :type renderer: Renderer
+    :param theme_files: The theme file paths.
+    :type theme_files: list
+    :param templates: The already compiled themes, by theme file path. The missing ones are loaded here.
+    :type templates: dict
+    """
+    def load_template(theme_file):
+        # None for the theme files without KEYs, which are copied (see Renderer.can_copy)
+        return None if renderer.can_copy(theme_file) else renderer.load(theme_file)
+
+    palette_path = os.path.normpath(os.path.abspath(os.path.expanduser(args.image or args.json or DEFAULT_COLORS_JSON_PATH)))
+    theme_root = os.path.normpath(args.theme.replace("~", HOME_PATH)) if args.theme else None
+    loaded, templates = templates, {}
+    for theme_file in theme_files:
+        try:
+            templates[os.path.normpath(theme_file) if theme_root else theme_file] = loaded.get(theme_file) or load_template(theme_file)
+        except (OSError, UnicodeDecodeError) as e:
+            logging.error(f"(walcord) can't read theme file {theme_file}: {e}")
+    outputs = {theme_file: get_output_path(get_theme_file_name(theme_file), args.output) for theme_file in templates}
+
+    watcher = InotifyWatcher() if InotifyWatcher.available() else PollingWatcher()
+    watcher.watch(os.path.dirname(palette_path))
+    if theme_root and os.path.isdir(theme_root):
+        watcher.watch(theme_root, recursive=True)
+    elif theme_root:
+        watcher.watch(os.path.dirname(theme_root) or ".")
+    logging.info(f"(walcord) service started ({type(watcher).__name__}), watching: {palette_path}" + (f", {theme_root}" if theme_root else ""))
+
+    while True:
+        try:
+            changed = wait_for_changes(watcher)
+        except KeyboardInterrupt:
+            logging.info("(walcord) service stopped.")
+            return
+
+        to_render = set()
+        if palette_path in changed and os.path.exists(palette_path):
+            try:
+                palette = load_palette(args)
+            except (Exception, SystemExit) as e: # one bad palette write mustn't stop the service (the backends may exit)
+                logging.error(f"(walcord) can't load colors from {palette_path}, keeping the current palette: {e}")
+                palette = renderer.palette
+            if palette != renderer.palette:
+                old_colors, new_colors = renderer.palette.colors, palette.colors
+                changed_keys = {key for key in old_colors.keys() | new_colors.keys() if old_colors.get(key) != new_colors.get(key)}
+                logging.info(f"(walcord) palette changed: {', '.join(sorted(changed_keys))}")
+                renderer.palette = palette
+                to_render.update(theme_file for theme_file, template in templates.items() if template is not None and not template_keys(template).isdisjoint(changed_keys))
+
+        written_paths = set(outputs.values()) | {mirror_path for output_path in outputs.values() for mirror_path in renderer.get_mirror_paths(output_path)}
+        for path in changed:
+            if path == palette_path or path in written_paths or not theme_root:
+                continue
+            if path != theme_root and not path.startswith(theme_root + os.sep):
+                continue
+            if path != theme_root and not match_globs(os.path.relpath(path, theme_root).replace(os.sep, "/"), args.include, args.exclude):
+                continue
+            if os.path.isfile(path):
+                logging.info(f"(walcord) theme file changed: {path}")
+                try:
+                    templates[path] = load_template(path)
+                except (OSError, UnicodeDecodeError) as e:
+                    logging.error(f"(walcord) can't read theme file {path}: {e}")
+                    continue
+                outputs[path] = get_output_path(get_theme_file_name(path), args.output)
+                to_render.add(path)
+            elif path in templates:
+                logging.info(f"(walcord) theme file removed: {path}")
+                del templates[path]
+                del outputs[path]
+                to_render.discard(path)
+
+        renderer.write_stats.clear()
+        for theme_file in sorted(to_render):
+            try:
+                if templates[theme_file] is None:
+                    renderer.copy(theme_file, outputs[theme_file])
+                else:
+                    renderer.generate(theme_file, templates[theme_file], outputs[theme_file])
+            except OSError as e:
+                logging.error(f"(walcord) can't write {outputs[theme_file]}: {e}")
+        if to_render:
+            renderer.save_manifest()
+            renderer.log_key_cache_stats()
+            renderer.log_write_stats()
+
+class RenderServer:
+    """
+    Renders templates sent over a Unix socket (--server). A request is one json line:
+    {"template": "..."} renders the template, {"name": "..."} renders a registered template and
+    {"register": "...", "template": "..."} registers one (the --theme files are registered by file name).
+    The response is one json line: {"ok": true, "text": "...", "palette": "<version>"} or {"ok": false, "error": "..."}.
+    Rendered texts are cached by template hash and palette version, and dropped when the palette changes.
+    """
+    def __init__(self, renderer: Renderer):
+        self.renderer = renderer
+        self.templates = collections.OrderedDict() # template hash -> compiled template, for sent templates
+        self.names = {} # registered name -> (template hash, compiled template)
+        self.responses = collections.OrderedDict() # (template hash, palette version) -> rendered text
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, text: str) -> list:
+        return compile_theme(text.splitlines(keepends=True), self.renderer.end)
+
+    def get_template(self, text: str) -> tuple:
+        """
+        Returns the hash and the compiled template of a sent template, compiled once while it stays in the cache.
+        """
+        template_hash = hashlib.sha1(text.encode()).hexdigest()
+        template = self.templates.get(template_hash)
+        if template is not None:
+            self.templates.move_to_end(template_hash)
+            return template_hash, template
+        template = self.templates[template_hash] = self.compile(text)
+        while len(self.templates) > SERVER_CACHE_MAX_ENTRIES:
+            self.templates.popitem(last=False)
+        return template_hash, template
+
+    def register(self, name: str, text: str) -> None:
+        self.names[name] = (hashlib.sha1(text.encode()).hexdigest(), self.compile(text))
+
+    def register_file(self, theme_file: str) -> None:
+        """
+        Registers the theme file by file name, compiled like the CLI does (see Renderer.load).
+        """
+        self.names[get_theme_file_name(theme_file)] = (hash_file(theme_file), self.renderer.load(theme_file))
+
+    def set_palette(self, palette: Palette) -> None:
+        """
+        Renders the next requests with the palette and drops the cached responses.
+        """
+        self.renderer.palette = palette
+        self.responses.clear()
+
+    async def render(self, template_hash: str, template: list, name: str) -> dict:
+        import asyncio
+        palette = self.renderer.palette
+        key = (template_hash, palette.version)
+        text = self.responses.get(key)
+        if text is not None:
+            self.hits += 1
+            self.responses.move_to_end(key)
+        else:
+            self.misses += 1
+            text = await asyncio.get_running_loop().run_in_executor(None, render_theme, template, palette, name)
+            if palette is self.renderer.palette:
+                self.responses[key] = text
+                while len(self.responses) > SERVER_CACHE_MAX_ENTRIES:
+                    self.responses.popitem(last=False)
+        return {"ok": True, "text": text, "palette": palette.version}
+
+    async def respond(self, line: bytes) -> dict:
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("the request must be a json object")
+            if "register" in request:
+                self.register(str(request["register"]), str(request["template"]))
+                return {"ok": True, "name": request["register"]}
+            if "name" in request:
+                if request["name"] not in self.names:
+                    raise KeyError(f"no template registered as {request['name']}")
+                return await self.render(*self.names[request["name"]], request["name"])
+            if "template" in request:
+                return await self.render(*self.get_template(str(request["template"])), "SERVER_TEMPLATE")
+            raise ValueError("expected 'template', 'name' or 'register'")
+        except (ValueError, KeyError, TypeError) as e:
+            return {"ok": False, "error": str(e.args[0]) if e.args else type(e).__name__}
+
+    async def handle_client(self, reader, writer) -> None:
+        import asyncio
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                writer.write(json.dumps(await self.respond(line)).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            logging.warning(f"(walcord) server client error: {e}")
+        finally:
+            writer.close()
+
+def get_server_socket_path() -> str:
+    """
+    Returns the default --server socket path: $XDG_RUNTIME_DIR/walcord.sock, or one in the walcord cache.
+    """
+    return os.path.join(os.environ.get("XDG_RUNTIME_DIR") or CACHE_PATH, "walcord.sock")
+
+def is_server_running(socket_path: str) -> bool:
+    """
+    Returns True if a server accepts connections on the Unix socket. A socket file left by a server
+    that didn't stop cleanly refuses them, and is stale.
+    """
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+            return True
+        except OSError:
+            return False
+
+def run_server(args: argparse.Namespace, renderer: Renderer, theme_files: list, socket_path: str) -> None:
+    """
+    Serves rendered templates on the Unix socket (see RenderServer) until interrupted,
+    reloading the palette when its source changes.
+
+    :param args: The parsed command line arguments.
+    :type args: argparse.Namespace
+    :param renderer: The renderer with the palette to serve.
+    :type renderer: Renderer
+    :param theme_files: The theme files to register by file name.
+    :type theme_files: list
+    :param socket_path: The path of the Unix socket.
+    :type socket_path: str
+    """
+    import asyncio
+    if not hasattr(asyncio, "start_unix_server"):
+        logging.error("(walcord) Error: --server needs Unix sockets, which this platform doesn't have.")
+        sys.exit(-1)
+    if os.path.exists(socket_path):
+        import pathlib
+        if not pathlib.Path(socket_path).is_socket():
+            logging.error(f"(walcord) Error: {socket_path} exists and is not a socket.")
+            sys.exit(-1)
+        if is_server_running(socket_path):
+            logging.error(f"(walcord) Error: a server is already listening on {socket_path}.")
+            sys.exit(-1)
+        logging.info(f"(walcord) removing the stale socket {socket_path}...")
+        os.remove(socket_path)
+
+    server = RenderServer(renderer)
+    for theme_file in theme_files:
+        try:
+            server.register_file(theme_file)
+        except (OSError, UnicodeDecodeError) as e:
+            logging.error(f"(walcord) can't register theme file {theme_file}: {e}")
+
+    palette_path = os.path.normpath(os.path.abspath(os.path.expanduser(args.image or args.json or DEFAULT_COLORS_JSON_PATH)))
+    watcher = InotifyWatcher() if InotifyWatcher.available() else PollingWatcher()
+    watcher.watch(os.path.dirname(palette_path))
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+
+        def reload_palette(changed):
+            if palette_path not in changed or not os.path.exists(palette_path):
+                return
+            try:
+                palette = load_palette(args)
+            except (Exception, SystemExit) as e: # one bad palette write mustn't stop the server (the backends may exit)
+                logging.error(f"(walcord) can't load colors from {palette_path}, keeping the current palette: {e}")
+                return
+            if palette != renderer.palette:
+                server.set_palette(palette)
+                logging.info(f"(walcord) palette changed ({palette.version}), cache cleared.")
+
+        def watch():
+            while True:
+                loop.call_soon_threadsafe(reload_palette, wait_for_changes(watcher))
+
+        threading.Thread(target=watch, daemon=True).start()
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        unix_server = await asyncio.start_unix_server(server.handle_client, socket_path, limit=SERVER_MAX_REQUEST_SIZE)
+        os.chmod(socket_path, 0o600)
+        logging.info(f"(walcord) server listening on {socket_path} ({len(server.names)} registered templates).")
+        async with unix_server:
+            await unix_server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        logging.info(f"(walcord) server stopped ({server.hits} cache hits, {server.misses} misses).")
+    finally:
+        if os.path.exists(socket_path): os.remove(socket_path)
+
+@contextlib.contextmanager
+def exit_on_error():
+    """
+    Turns the errors raised by the walcord functions (loading a palette, a missing optional dependency...)
+    into an error message and the exit code of the command line. The functions never exit themselves,
+    so they can be used in long-running processes.
+    """
+    try:
+        yield
+    except (OSError, ValueError, KeyError, TypeError, ImportError) as e:
+        logging.error(f"(walcord) Error: {e.args[0] if isinstance(e, KeyError) else e}")
+        sys.exit(-1)
+
+def setup_logging(level: int = logging.INFO) -> None:
+    """
+    Configures the walcord log format. It's done in main, so importing walcord doesn't touch the logging config.
+    """
+    logging.basicConfig(level=level)
+    logging.getLogger().setLevel(level)
+    logging.getLogger().handlers[0].setFormatter(logging.Formatter('%(asctime)s (%(levelname)s) - %(message)s'))
 
 def main():
-    global colors
-    global VESKTOP_THEME_PATH
     global IS_STDIN
 
     parser = argparse.ArgumentParser(description="Create a theme file from pywal colors.")
     parser.add_argument("--image", "-i", type=str, help="The path to the image to generate colors from.", required=False)
+    parser.add_argument("--backend", type=str, choices=IMAGE_BACKENDS.keys(), default="pywal", help="The backend to generate colors from images with: pywal, or native (numpy and Pillow, no external tools). (default: pywal)", required=False)
     parser.add_argument("--theme", "-t", type=str, help="The path to the theme file to replace colors in.", required=False)
-    parser.add_argument("--output", "-o", type=str, help="The path to the output file. default: ~/.config/vesktop/themes/", required=False)
+    parser.add_argument("--output", "-o", type=str, action="append", help="The path to the output file. default: ~/.config/vesktop/themes/ Can be repeated to put the themes in several places (e.g. Vesktop, Vencord and BetterDiscord), they are rendered once.", required=False)
     parser.add_argument("--quiet", "-q", action="store_true", help="Don't print anything.", required=False)
     parser.add_argument("--extention", "-e", type=str, help="The extention of the theme file, if you use stdin. (default: '.css')", required=False)
     parser.add_argument("--json", "-j", type=str, help="colors.json file with pywal colors", required=False)
     parser.add_argument("--stdin", "-si", action="store_true", help="Read theme from stdin.", required=False)
-    #parser.add_argument("--service", "-s", type=bool, help="Work as a service.", required=False)
-    parser.add_argument("--version", "-v", action="version", version="2.9.1")
+    parser.add_argument("--stream", type=str, nargs="?", const="length", choices=("length", "nul"), default=None, help="Render many themes from stdin, one by one as they arrive, to stdout (or to --output). Every theme is a json header line with its length (and name/extention), or, with 'nul', themes are separated by NUL bytes. (default: length)", required=False)
+    parser.add_argument("--batch", "-b", type=str, nargs="+", help="Render the themes with every palette source (colors.json files or images) into --output/<palette name>/. Use @file to read the sources from a file, one per line.", required=False)
+    parser.add_argument("--include", type=str, action="append", metavar="GLOB", help="Only take the files of the --theme directory matching GLOB (can be repeated).", required=False)
+    parser.add_argument("--exclude", type=str, action="append", metavar="GLOB", help="Skip the files of the --theme directory matching GLOB (can be repeated).", required=False)
+    parser.add_argument("--transition", type=str, metavar="SOURCE", help="Render the frames of a transition from the SOURCE palette (a colors.json file or an image) to the --json/--image one into --output/<frame>/.", required=False)
+    parser.add_argument("--frames", type=int, default=30, help="The number of --transition frames. (default: 30)", required=False)
+    parser.add_argument("--space", type=str, choices=("rgb", "hls"), default="rgb", help="The color space --transition interpolates in. (default: rgb)", required=False)
+    parser.add_argument("--server", type=str, nargs="?", const="", default=None, metavar="SOCKET", help="Serve rendered templates on a Unix socket (default: $XDG_RUNTIME_DIR/walcord.sock). The --theme files are registered by file name.", required=False)
+    parser.add_argument("--prewarm", type=str, metavar="DIR", help="Extract the palettes of every image in DIR into the palette cache in the background (on --jobs processes, at a low priority), so switching to them later is instant.", required=False)
+    parser.add_argument("--jobs", type=int, default=1, help="Render theme files on N worker processes (0 = number of CPUs). (default: 1)", required=False)
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write walcord caches.", required=False)
+    parser.add_argument("--service", "-s", action="store_true", help="Work as a service: re-render the themes when the colors or the themes change.", required=False)
+    parser.add_argument("--stats", type=str, nargs="?", const="", default=None, metavar="FILE", help="Print the time of every stage and per file metrics, or write them as json to FILE ('-' for stdout).", required=False)
+    parser.add_argument("--version", "-v", action="version", version=VERSION)
     args = parser.parse_args()
+    args.output, mirrors = (args.output[0], args.output[1:]) if args.output else (None, [])
 
-    if args.quiet: logging.getLogger().setLevel(logging.ERROR)
+    setup_logging(logging.ERROR if args.quiet else logging.INFO)
+    stats = RunStats() if args.stats is not None else None
+    IS_STDIN = args.stdin and bool(select.select([sys.stdin], [], [], 0.0)[0])
+    end = "\n" if not args.theme else ""
 
-    logging.info(f"(walcord) gettings colors...")
-    if args.json:
-        colors = get_colors_json(args.json)
-    else:
-        colors = get_colors_pywal(args.image) if args.image else get_colors_json()
-    colors = hex_to_rgb_map(map_colors(colors))
+    if args.prewarm:
+        if not os.path.isdir(args.prewarm):
+            logging.error(f"(walcord) Error: Is not an existing directory: {args.prewarm}")
+            sys.exit(-1)
+        if args.no_cache:
+            logging.error("(walcord) Error: You can't use --prewarm with --no-cache.")
+            sys.exit(-1)
+        run_prewarm(args.prewarm, args.backend, args.jobs if args.jobs > 0 else os.cpu_count() or 1)
+        logging.info("(walcord) DONE.")
+        return
 
+    if args.batch:
+        if args.stdin or args.service or args.image or args.json or args.transition or args.server is not None or args.stream:
+            logging.error("(walcord) Error: You can't use --batch with --stdin, --service, --image, --json, --transition, --server or --stream.")
+            sys.exit(-1)
+        if not args.output or "." in os.path.basename(args.output) or mirrors:
+            logging.error("(walcord) Error: --batch needs one --output directory.")
+            sys.exit(-1)
+        try:
+            sources = expand_batch_sources(args.batch)
+        except OSError as e:
+            logging.error(f"(walcord) Error: can't read the --batch sources: {e}")
+            sys.exit(-1)
+        with timed(stats, "themes"):
+            theme_files = check_themes(args.theme, args.include, args.exclude) if args.theme else ["DEFAULT_THEME"]
+        check_path(args.output, theme_count=len(theme_files))
+        with exit_on_error():
+            renderer = run_batch(sources, theme_files, end, args.output, not args.no_cache, args.backend, stats)
+        renderer.log_write_stats()
+        logging.info("(walcord) DONE.")
+        if stats is not None: report_stats(stats, args.stats or None)
+        return
+
+    if args.stream:
+        if args.theme or args.service or args.transition or args.server is not None or mirrors:
+            logging.error("(walcord) Error: You can't use --stream with --theme, --service, --transition, --server or several --output.")
+            sys.exit(-1)
+        with exit_on_error():
+            renderer = Renderer(load_palette(args), end, not args.no_cache)
+        if args.output:
+            check_path(args.output)
+        try:
+            run_stream(renderer, sys.stdin.buffer, sys.stdout.buffer, args.stream, args.output, args.extention)
+        except (ValueError, KeyError) as e:
+            logging.error(f"(walcord) Error: bad --stream input: {e}")
+            sys.exit(-1)
+        return
+
+    if args.server is not None:
+        if args.stdin or args.service or args.transition:
+            logging.error("(walcord) Error: You can't use --server with --stdin, --service, --transition or --batch.")
+            sys.exit(-1)
+        with exit_on_error():
+            renderer = Renderer(load_palette(args), "", not args.no_cache)
+        theme_files = check_themes(args.theme, args.include, args.exclude) if args.theme else []
+        run_server(args, renderer, theme_files, args.server or get_server_socket_path())
+        return
+
+    if args.transition:
+        if args.stdin or args.service:
+            logging.error("(walcord) Error: You can't use --transition with --stdin, --service or --batch.")
+            sys.exit(-1)
+        if not args.output or "." in os.path.basename(args.output) or mirrors:
+            logging.error("(walcord) Error: --transition needs one --output directory.")
+            sys.exit(-1)
+        if args.frames < 1:
+            logging.error("(walcord) Error: --frames must be at least 1.")
+            sys.exit(-1)
+        with timed(stats, "palette"), exit_on_error():
+            old, new = Palette.load(args.transition, not args.no_cache, args.backend), load_palette(args)
+        with timed(stats, "themes"):
+            theme_files = check_themes(args.theme, args.include, args.exclude) if args.theme else ["DEFAULT_THEME"]
+        check_path(args.output, theme_count=len(theme_files))
+        with exit_on_error():
+            renderer = run_transition(old, new, args.frames, args.space, theme_files, end, args.output, not args.no_cache, stats)
+        renderer.log_write_stats()
+        logging.info("(walcord) DONE.")
+        if stats is not None: report_stats(stats, args.stats or None)
+        return
+
+    with timed(stats, "palette"), exit_on_error():
+        renderer = Renderer(load_palette(args), end, not args.no_cache, stats, RenderManifest() if not args.no_cache else None, mirrors)
+
+    stdin_data = None
     if IS_STDIN and args.stdin:
         if args.theme:
             logging.error("(walcord) Error: You can't use stdin with --theme.")
             sys.exit(-1)
+        if args.service:
+            logging.error("(walcord) Error: You can't use stdin with --service.")
+            sys.exit(-1)
         logging.info("(walcord) getting data from stdin...")
-        stdin_data = sys.stdin.read().split("\n")
-        theme_files_paths.append("STDIN_THEME")
+        stdin_data = iter_split_lines(sys.stdin)
+        theme_files = ["STDIN_THEME"]
 
     else:
-        if args.theme: 
-            check_themes(args.theme)
-        else: 
-            theme_files_paths.append("DEFAULT_THEME")
-
-    if args.output: 
-        logging.info(f"(walcord) checking output path: {args.output}")
-        check_path(args.output)
-
-    for theme_file in theme_files_paths:
-        VESKTOP_THEME_PATH = ORIGIN_VESKTOP_THEME_PATH
-        logging.info(f"(walcord) working on the file: {theme_file}")
-        if theme_file == "DEFAULT_THEME":
-            theme_lines = DEFAULT_THEME.split("\n")
-            theme_file_name = "walcord.theme.css"
-        elif theme_file == "STDIN_THEME":
-            theme_lines = stdin_data
-            theme_file_name = "stdin.walcord.theme.css"
-            for i in range(len(theme_lines)):
-                if "@name" in theme_lines[i]:
-                    theme_file_name = theme_lines[i].split(" ")[-1].strip()
-                    theme_file_name += ".css" if not args.extention else args.extention
-
-        else:
-            theme_file_name = os.path.basename(theme_file)
-            theme_lines = open(theme_file, "r+").readlines()
-
-        VESKTOP_THEME_PATH = args.output if args.output else os.path.join(VESKTOP_THEME_PATH, theme_file_name)
-        if not "." in VESKTOP_THEME_PATH[1:]: VESKTOP_THEME_PATH = os.path.join(VESKTOP_THEME_PATH, theme_file_name)
-
-        logging.info(f"(walcord) start to generate theme file...")
-        for i in range(len(theme_lines)):
-            if "@description" in theme_lines[i]:
-                theme_lines[i] = " * @description Generated by Walcord\n"
-                break
-        
-        theme_text = try_replace_key_in_theme(theme_lines, theme_file, "\n" if not args.theme else "")
-            
-        logging.info(f"(walcord) writing theme file to: {VESKTOP_THEME_PATH}")
-        with open(VESKTOP_THEME_PATH, "w+") as file: file.write(theme_text)
-        logging.info(f"(walcord) {VESKTOP_THEME_PATH} generated successfully.")
+        with timed(stats, "themes"):
+            if args.theme: 
+                theme_files = check_themes(args.theme, args.include, args.exclude)
+            else: 
+                theme_files = ["DEFAULT_THEME"]
+
+    for output in filter(None, [args.output] + mirrors): 
+        logging.info(f"(walcord) checking output path: {output}")
+        check_path(output, theme_count=len(theme_files))
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+    outputs = [(theme_file, get_output_path(get_theme_file_name(theme_file), args.output)) for theme_file in theme_files if theme_file != "STDIN_THEME"]
+    templates = {}
+    if stdin_data is not None:
+        logging.info(f"(walcord) working on the file: STDIN_THEME")
+        renderer.generate_stdin(stdin_data, args.output, args.extention)
+    elif jobs > 1 and len(outputs) > 1:
+        render_themes_parallel(renderer, outputs, jobs)
+    else:
+        for theme_file, output_path in outputs:
+            logging.info(f"(walcord) working on the file: {theme_file}")
+            try:
+                if renderer.is_up_to_date(theme_file, output_path):
+                    if args.service and not renderer.can_copy(theme_file):
+                        templates[theme_file] = renderer.load(theme_file)
+                    renderer.skip(theme_file, output_path)
+                    continue
+                if renderer.can_copy(theme_file):
+                    renderer.copy(theme_file, output_path)
+                    continue
+                template = iter_theme(theme_file, end, use_cache=renderer.use_cache)
+                if args.service:
+                    template = templates[theme_file] = list(template)
+                renderer.generate(theme_file, template, output_path)
+            except (OSError, UnicodeDecodeError) as e:
+                logging.error(f"(walcord) can't generate theme from {theme_file}: {e}")
+    renderer.save_manifest()
+    renderer.log_key_cache_stats()
+    renderer.log_write_stats()
     logging.info("(walcord) DONE.")
+    if stats is not None:
+        report_stats(stats, args.stats or None)
+        renderer.stats = None
+
+    if args.service:
+        run_service(args, renderer, theme_files, templates)
 
 if __name__ == "__main__":
+    if getattr(sys, "frozen", False):
+        import multiprocessing
+        multiprocessing.freeze_support()
     main()
@@ -10,7 +10,7 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=['numpy', 'PIL'], # the optional native backend (requirements-native.txt), kept out of the one-file binary
     noarchive=False,
     optimize=0,
 )